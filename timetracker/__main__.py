@@ -22,108 +22,382 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-try:
-    import sqlalchemy
-except ImportError:
-    print("Cannot run. Please run 'setup.bat' before continuing.")
-    import sys
-    sys.exit()
-
+# Only the standard library is imported up here. When an instance is already
+# running, all we do is ask it to open its GUI, and that shouldn't have to wait
+# for sqlalchemy, tkinter or the db. Everything else is imported where it's used.
 
-import tkinter as tk
 import argparse
+import importlib
 import logging
 from logging.handlers import RotatingFileHandler
+import os.path
 import sys
 
-import utils
-from app import Application
-import updater
+# modules in this folder import each other directly,
+# this lets 'python -m timetracker' work as well as 'python timetracker'
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import instance
+import control
 
 
 max_bytes = 32 * 1024 * 1024  # 32 MiB
 log = logging.getLogger("timetracker")
 log.setLevel(logging.INFO)
 sh = logging.StreamHandler()
-handler = RotatingFileHandler(
-    filename="timetracker.log",
-    encoding="utf-8",
-    mode="w",
-    maxBytes=max_bytes,
-    backupCount=5,
-)
 fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
 sh.setFormatter(fmt)
-handler.setFormatter(fmt)
 log.addHandler(sh)
-log.addHandler(handler)
 
 
-def main():
-    log.info("Starting app...")
+def add_file_handler():
+    """Logs to timetracker.log as well
 
-    other_proc = utils.is_already_running()
+    This isn't done for the one-off commands (like report) since it
+    would wipe the log of an instance that's already running.
+    """
+    handler = RotatingFileHandler(
+        filename="timetracker.log",
+        encoding="utf-8",
+        mode="w",
+        maxBytes=max_bytes,
+        backupCount=5,
+    )
+    handler.setFormatter(fmt)
+    log.addHandler(handler)
 
-    if not other_proc:
-        log.info("Instance check passed")
 
+class CommandParser(argparse.ArgumentParser):
+    """Parser for a subcommand that only imports its module when the subcommand is used
+
+    The module's add_arguments(parser) fills in the arguments.
+    """
+
+    def __init__(self, *args, module=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.module = module
+
+    def parse_known_args(self, args=None, namespace=None):
+        if self.module:
+            importlib.import_module(self.module).add_arguments(self)
+            self.module = None
+
+        return super().parse_known_args(args, namespace)
+
+
+def check_dependencies():
+    """Exits if the dependencies haven't been installed"""
+    try:
+        import sqlalchemy  # noqa: F401
+    except ImportError:
+        print("Cannot run. Please run 'setup.bat' before continuing.")
+        sys.exit()
+
+
+def rebuild_totals():
+    """Recalculates the daily_totals table"""
+    from models import init_db
+    import totals
+
+    # the rebuild is one transaction, which on a big db holds the write lock for
+    # longer than the app's busy timeout, and the app's in-memory totals would go
+    # stale. holding the lockfile also keeps it from starting until we're done
+    if instance.is_already_running(instance.MAINTENANCE):
+        log.info("TimeTracker is running, close it before rebuilding the totals")
+        return
+
+    try:
+        engine = init_db()
+        log.info("Rebuilding daily totals...")
+        with engine.begin() as conn:
+            totals.rebuild(conn)
+
+    finally:
+        instance.delete_lockfile()
+
+
+def convert_timestamps(target):
+    """Rewrites the time entries' timestamps in another storage format, then compacts the db"""
+    from models import init_db
+    import timestamps
+
+    # the app can't be running while the entries change format under it.
+    # holding the lockfile also keeps it from starting until we're done
+    if instance.is_already_running(instance.MAINTENANCE):
+        log.info("TimeTracker is running, close it before converting timestamps")
+        return
+
+    try:
+        engine = init_db()
+        path = engine.url.database
+        size = os.path.getsize(path)
+
+        timestamps.convert(engine, target)
+
+        # the space the old values took is only given back to the filesystem by a vacuum
+        log.info("Vacuuming...")
+        with engine.connect() as conn:
+            conn.exec_driver_sql("VACUUM")
+
+        log.info(f"The db went from {size / 1024 ** 2:.1f} MiB to {os.path.getsize(path) / 1024 ** 2:.1f} MiB")
+
+    finally:
+        instance.delete_lockfile()
+
+
+def apply_retention(days):
+    """Deletes entries older than ``days`` days (keeping their daily totals) and compacts the db"""
+    from models import init_db
+    from retention import RetentionJob
+
+    # the full vacuum below can't share the db with a running instance.
+    # holding the lockfile also keeps it from starting until we're done
+    if instance.is_already_running(instance.MAINTENANCE):
+        log.info("TimeTracker is running, close it first (or set retention_days in the config)")
+        return
+
+    try:
+        engine = init_db()
+        path = engine.url.database
+        size = os.path.getsize(path)
+
+        job = RetentionJob(engine, days)
+        job.run()
+
+        with engine.connect() as conn:
+            incremental = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2
+
+        if not incremental:
+            # one full vacuum, which also lets later runs vacuum incrementally
+            log.info("Vacuuming...")
+            job.vacuum()
+
+        log.info(f"The db went from {size / 1024 ** 2:.1f} MiB to {os.path.getsize(path) / 1024 ** 2:.1f} MiB")
+
+    finally:
+        instance.delete_lockfile()
+
+
+def dump_metrics():
+    """Asks the running instance to dump its metrics"""
+    try:
+        control.send_command("dump_metrics")
+    except Exception:
+        log.info("Couldn't reach a running instance")
     else:
-        log.info("Another instance is running, requesting it to open its GUI...")
-        try:
-            utils.multiprocess_sender()
-            log.info("Sent message. Hopefully it worked? Exiting...")
-            return
+        log.info("Metrics were written to timetracker.log")
 
-        except Exception:
-            log.info("Message failed to send. Uh oh. Attempting to kill other process...")
 
-            try:
-                other_proc.kill()
-            except Exception:
-                log.info("Failed to kill other process. Writing to lockfile and continuing with startup...")
-                utils.write_pid()
+def run_update():
+    """Runs the updater on its own"""
+    import tkinter as tk
+    import updater
+
+    root = tk.Tk()
+    root.withdraw()
+    log.info("Update arg specified, performing update...")
+    updater.perform_update(root, restart=False)
+
+
+def run_report(args):
+    """Prints a report of the tracked time"""
+    from models import init_db
+    import reports
+
+    reports.run(args, init_db())
+
+
+def run_export(args):
+    """Streams the time entries out to a file or stdout"""
+    from models import init_db
+    import exporter
+
+    exporter.run(args, init_db())
+
+
+def run_import(args):
+    """Bulk imports time entries from a file"""
+    from models import init_db
+    import importer
+
+    # each transaction holds the write lock for longer than the app's busy timeout.
+    # holding the lockfile also keeps it from starting until we're done
+    if instance.is_already_running(instance.MAINTENANCE):
+        log.info("TimeTracker is running, close it before importing")
+        return
+
+    try:
+        importer.run(args, init_db())
+    finally:
+        instance.delete_lockfile()
 
-            else:
-                log.info("Successfully killed other process. Writing to lockfile and continuing with startup...")
-                utils.write_pid()
 
+def main():
     log.info("Parsing args...")
     # parse CLI args
     parser = argparse.ArgumentParser(
         description="Time Tracker: A Windows app written in Python that tracks your time for specified apps"
     )
     parser.add_argument(
-        "--no-gui", help="A flag that disables the GUI on start", action="store_true"
+        "--no-gui",
+        help="Runs in the background without the GUI (or Tk). Starting the app again opens it",
+        action="store_true",
     )
     parser.add_argument(
         "--update", "-U", help="A flag that updates the app", action="store_true"
     )
+    parser.add_argument(
+        "--dump-metrics",
+        help="Asks the running instance to write its metrics to timetracker.log and exits",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rebuild-totals",
+        help="Recalculates the daily totals from every time entry and exits",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--convert-timestamps",
+        metavar="FORMAT",
+        choices=("iso", "epoch_s", "epoch_ms"),
+        help="Stores time entry timestamps as ISO text (the default), or integer seconds "
+        "or milliseconds since the epoch (smaller and faster to filter), and exits",
+    )
+    parser.add_argument(
+        "--apply-retention",
+        metavar="DAYS",
+        type=int,
+        help="Deletes time entries that ended more than DAYS days ago, keeping their daily "
+        "totals, compacts the db and exits",
+    )
+
+    subparsers = parser.add_subparsers(dest="command", parser_class=CommandParser)
+    subparsers.add_parser(
+        "report", help="Print a report of the time tracked over a range of days", module="reports"
+    )
+    subparsers.add_parser(
+        "export",
+        help="Export time entries as CSV, JSON Lines or a compact binary format",
+        module="exporter",
+    )
+    subparsers.add_parser(
+        "import", help="Bulk import time entries from a CSV or JSON Lines file", module="importer"
+    )
+    subparsers.add_parser(
+        "ctl",
+        help="Send a command (status, today_totals, pause, ...) to the running instance",
+        module="control",
+    )
+
     args = parser.parse_args()
 
-    log.info("Setting up Tk...")
-    # setup and start the tkinter root
-    root = tk.Tk()
-    root.title("Time Tracker")
-    root.iconbitmap("icon.ico")
-    root.resizable(width=False, height=False)
+    if args.apply_retention is not None and args.apply_retention < 1:
+        parser.error("--apply-retention needs at least 1 day")
+
+    if args.dump_metrics:
+        dump_metrics()
+        return
+
+    if args.command == "ctl":
+        control.run(args)
+        return
+
+    maintenance = args.rebuild_totals or args.convert_timestamps or args.apply_retention is not None
+    if maintenance or args.command:
+        check_dependencies()
+
+    if args.rebuild_totals:
+        rebuild_totals()
+        return
+
+    if args.convert_timestamps:
+        convert_timestamps(args.convert_timestamps)
+        return
+
+    if args.apply_retention is not None:
+        apply_retention(args.apply_retention)
+        return
+
+    if args.command == "report":
+        run_report(args)
+        return
+
+    if args.command == "export":
+        run_export(args)
+        return
+
+    if args.command == "import":
+        run_import(args)
+        return
+
+    log.info("Starting app...")
+
+    # usually there's an instance running that just needs to open its GUI.
+    # try that first, before anything slow is imported
+    if instance.has_lockfile():
+        log.info("Another instance may be running, requesting it to open its GUI...")
+        try:
+            control.send_command("open_gui")
+            log.info("Sent message. Hopefully it worked? Exiting...")
+            return
+
+        except Exception:
+            log.info("Message failed to send, checking if the other instance is still running...")
+
+    other_proc = instance.is_already_running()
+
+    if not other_proc:
+        log.info("Instance check passed")
+
+    elif instance.read_lockfile()[1] == instance.MAINTENANCE:
+        # it isn't hung, it just doesn't serve the control channel
+        log.info("A maintenance command (like --convert-timestamps) is running. Start TimeTracker once it's done")
+        return
+
+    else:
+        log.info("Other instance isn't responding. Uh oh. Attempting to kill other process...")
+
+        try:
+            other_proc.kill()
+        except Exception:
+            log.info("Failed to kill other process. Writing to lockfile and continuing with startup...")
+            instance.write_pid()
+
+        else:
+            log.info("Successfully killed other process. Writing to lockfile and continuing with startup...")
+            instance.write_pid()
+
+    check_dependencies()
+
+    # only added now so a second instance doesn't wipe the running one's log
+    add_file_handler()
 
     if args.update:
-        root.withdraw()
-        log.info("Update arg specified, performing update...")
-        updater.perform_update(root, restart=False)
+        run_update()
         return
 
-    Application(root, args.no_gui).grid(column=0, row=0)
+    from models import init_db
+    from tracker import Tracker
+
+    log.info("Setting up the db...")
+    init_db()
 
-    if args.no_gui:
-        root.withdraw()
+    # the tracker never imports tkinter. the GUI is only loaded when it's opened
+    tracker = Tracker()
+
+    if not args.no_gui:
+        tracker.open_gui()
+
+    try:
+        tracker.run()
+    except KeyboardInterrupt:
+        log.info("Interrupted, stopping...")
 
-    log.info("Starting mainloop...")
-    root.mainloop()
+    tracker.close()
 
     log.info("Deleting lockfile...")
     try:
-        result = utils.delete_lockfile()
+        result = instance.delete_lockfile()
         if not result:
             log.info("Lockfile does not exist, skipping deletion")
 
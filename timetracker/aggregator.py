@@ -0,0 +1,115 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import datetime
+import threading
+import logging
+
+import totals
+
+
+log = logging.getLogger("timetracker.aggregator")
+
+
+class TodayAggregator:
+    """Keeps today's per-program totals in memory
+
+    It listens to the Tracker's start/stop transitions, so showing
+    today's time never has to touch the database. The totals are only read
+    from the db when the aggregator is created and when the day rolls over.
+
+    ``load_day`` is called with a date and should return a dict of
+    program id to seconds, like :meth:`models.DailyTotal.get_day`.
+    """
+
+    def __init__(self, load_day):
+        self._load_day = load_day
+        self._lock = threading.Lock()
+
+        self.day = None
+        self.totals = {}  # program_id: seconds
+        self.current = None  # (program_id, utc start datetime) of the running entry
+
+        # bumped whenever the totals or the running entry change, so the GUI
+        # only has to take a new snapshot when it's different
+        self.version = 0
+
+        self.load()
+
+    def load(self, day=None):
+        """(Re)loads a day's totals from the db"""
+        day = day or datetime.date.today()
+        day_totals = self._load_day(day)
+
+        with self._lock:
+            self.day = day
+            self.totals = dict(day_totals)
+            self.version += 1
+
+        log.info(f"Loaded totals for {day}")
+
+    def program_started(self, entry):
+        """Called when an entry starts"""
+        with self._lock:
+            self.current = (entry.program_id, entry.start_datetime)
+            self.version += 1
+
+    def program_stopped(self, entry):
+        """Called when an entry stops"""
+        with self._lock:
+            self.current = None
+
+            for day, seconds in totals.split_by_day(entry.start_datetime, entry.end_datetime):
+                if day > self.day:
+                    # the day rolled over while the entry was running
+                    self.day = day
+                    self.totals = {}
+
+                if day == self.day:
+                    self.totals[entry.program_id] = self.totals.get(entry.program_id, 0.0) + seconds
+
+            self.version += 1
+
+    def snapshot(self):
+        """Returns today's totals and the running entry
+
+        The return value is a tuple of ({program_id: seconds}, (program_id, utc start) or None).
+        """
+        if datetime.date.today() != self.day:
+            self.load()
+
+        with self._lock:
+            return dict(self.totals), self.current
+
+    def live_totals(self, now=None):
+        """Returns today's {program_id: seconds}, counting the running entry up to now"""
+        totals_today, current = self.snapshot()
+
+        if current:
+            program_id, start = current
+            for day, seconds in totals.split_by_day(start, now or datetime.datetime.utcnow()):
+                if day == self.day:
+                    totals_today[program_id] = totals_today.get(program_id, 0.0) + seconds
+
+        return totals_today
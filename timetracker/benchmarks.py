@@ -0,0 +1,760 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Benchmark suite for the tracking and display hot paths
+#
+# Everything runs headless: processes come from sources.SyntheticActivitySource
+# and databases are generated into a temp folder. Run with
+#
+#   python timetracker/benchmarks.py [--size quick|full] [--output results.json]
+#                                    [--compare baseline.json] [--threshold 0.25]
+#
+# Results are saved as JSON. When --compare is given, any metric that got worse
+# than the baseline by more than the threshold is flagged and the exit code is 1.
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import matching
+import utils
+from sources import SyntheticActivitySource
+
+
+PROGRAM_NAMES = ["chrome.exe", "code.exe", "discord.exe", "spotify.exe", "slack.exe"]
+
+# process table sizes, and (entries, programs) database sizes
+SIZES = {
+    "quick": {
+        "processes": (1000, 5000),
+        "databases": ((1_000, 10), (100_000, 100)),
+    },
+    "full": {
+        "processes": (1000, 5000, 20000),
+        "databases": ((1_000, 10), (100_000, 100), (1_000_000, 100), (10_000_000, 1000)),
+    },
+}
+
+# name, function. filled in by @benchmark
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Registers a benchmark. It gets called with (results, size, databases)"""
+    BENCHMARKS.append((func.__name__.replace("bench_", ""), func))
+    return func
+
+
+class Results:
+    """Collects named measurements"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit="s", better="lower"):
+        self.metrics[name] = {"value": value, "unit": unit, "better": better}
+
+        if unit == "s":
+            shown = f"{value * 1000:12.3f} ms"
+        else:
+            shown = f"{value:12.4g} {unit}"
+        print(f"  {name:<48} {shown}")
+
+    def to_json(self, size):
+        return {
+            "meta": {
+                "created_at": datetime.datetime.utcnow().isoformat(),
+                "size": size,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+            },
+            "results": self.metrics,
+        }
+
+
+class Databases:
+    """Generates (and reuses) databases of a given size in a folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.paths = {}
+
+    def get(self, entries, programs):
+        key = (entries, programs)
+        if key not in self.paths:
+            path = os.path.join(self.folder, f"{entries}x{programs}.db")
+            print(f"  (generating {entries} entries for {programs} programs...)")
+            self.paths[key] = generate_database(path, entries, programs)
+
+        return self.paths[key]
+
+
+def timeit(func, repeat=20):
+    """Calls func ``repeat`` times and returns the median time in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def generate_database(path, entries, programs=len(PROGRAM_NAMES), days=365):
+    """Fills a SQLite database with ``entries`` fake time entries spread over ``days``
+
+    Entries are written with sqlite3 directly because the ORM is far too slow for this.
+    The database is migrated afterwards, so it has indexes and daily totals.
+    Returns the path.
+    """
+    import sqlalchemy
+    import models
+    import migrations
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO programs (id, name, process_name, location) VALUES (?, ?, ?, ?)",
+        ((i + 1, f"Program {i}", f"program{i}.exe", "") for i in range(programs)),
+    )
+
+    now = datetime.datetime.utcnow()
+    step = days * 86400 / entries
+    fmt = "%Y-%m-%d %H:%M:%S.%f"
+
+    def rows():
+        start = now - datetime.timedelta(days=days)
+        for i in range(entries):
+            end = start + datetime.timedelta(seconds=step * 0.9)
+            yield (i % programs + 1, start.strftime(fmt), end.strftime(fmt))
+            start += datetime.timedelta(seconds=step)
+
+    conn.executemany(
+        "INSERT INTO time_entrys (program_id, start_datetime, end_datetime) VALUES (?, ?, ?)",
+        rows(),
+    )
+    # one open entry, like there would be while tracking
+    conn.execute(
+        "INSERT INTO time_entrys (program_id, start_datetime) VALUES (1, ?)",
+        (now.strftime(fmt),),
+    )
+    conn.commit()
+    conn.close()
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    sqlalchemy.event.listen(engine, "connect", migrations.set_pragmas)
+    migrations.upgrade(engine)
+    engine.dispose()
+    return path
+
+
+def synthetic_desktop(processes):
+    """A synthetic source with ``processes`` processes plus the tracked ones, one focused"""
+    source = SyntheticActivitySource(processes, seed=0)
+    for name in PROGRAM_NAMES:
+        source.spawn(name)
+    source.focus(PROGRAM_NAMES[0])
+    return source
+
+
+def start_worker(folder):
+    """Starts a :class:`dbworker.DatabaseWorker` on a new db in ``folder``. Close it when done"""
+    import sqlalchemy
+    from sqlalchemy.orm import sessionmaker
+    import models
+    import migrations
+    from dbworker import DatabaseWorker
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(folder, 'tracking.db')}")
+    sqlalchemy.event.listen(engine, "connect", migrations.set_pragmas)
+    models.Base.metadata.create_all(engine)
+
+    worker = DatabaseWorker(sessionmaker(bind=engine))
+    worker.start()
+    return worker
+
+
+def headless_tracker(source, db, resolution_mode):
+    """A :class:`tracker.Tracker` with just what :meth:`Tracker.activity_tick` uses
+
+    ``Tracker()`` would also start its activity loop (which would tick alongside
+    the benchmark), the control server and the updater. The tracked programs are
+    PROGRAM_NAMES, and starts and stops go to the :class:`dbworker.DatabaseWorker` ``db``.
+    """
+    from models import Program
+    from registry import ProgramRegistry
+    from tracker import Tracker
+
+    programs = [Program(id=i + 1, name=name, process_name=name) for i, name in enumerate(PROGRAM_NAMES)]
+
+    tracker = Tracker.__new__(Tracker)
+    tracker.config = {"mouse_timeout": 10, "resolution_mode": resolution_mode}
+    tracker.source = source
+    tracker.db = db
+    tracker.registry = ProgramRegistry(lambda: programs)
+    tracker.listeners = []
+    tracker.paused = False
+    tracker.last_idle_time = None
+    tracker.current_program = None
+    tracker.current_title = None
+    tracker.foreground_pid = None
+    tracker.foreground_version = None
+    tracker.foreground_program = None
+    return tracker
+
+
+# == Process table ==
+
+
+@benchmark
+def bench_get_processes(results, size, databases, churn=0.001):
+    """utils.get_processes (full scan) vs utils.ProcessIndex, with 0.1% churn per tick"""
+    for count in size["processes"]:
+        source = synthetic_desktop(count)
+        index = utils.ProcessIndex(source.pids, source.process)
+        index.get_processes(PROGRAM_NAMES)  # warm it up
+
+        def full_scan():
+            source.random_step(churn=churn)
+            utils.get_processes(PROGRAM_NAMES, source.process_iter)
+
+        def indexed():
+            source.random_step(churn=churn)
+            index.get_processes(PROGRAM_NAMES)
+
+        results.add(f"get_processes/full_scan/{count}", timeit(full_scan))
+        results.add(f"get_processes/index/{count}", timeit(indexed))
+
+
+@benchmark
+def bench_activity_tick(results, size, databases, focus_change=0.05):
+    """Tracker.activity_tick in scan and foreground mode, with focus moving on 5% of ticks
+
+    Focus changes start and stop entries on a real DatabaseWorker, like they
+    would in the app.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        worker = start_worker(tmp)
+
+        for count in size["processes"]:
+            for mode in ("scan", "foreground"):
+                source = synthetic_desktop(count)
+                tracker = headless_tracker(source, worker, mode)
+                tracker.activity_tick()  # loads the registry and builds the process index
+
+                def tick():
+                    source.random_step(churn=0, focus_change=focus_change, idle_chance=0)
+                    tracker.activity_tick()
+
+                results.add(f"activity_tick/{mode}/{count}", timeit(tick, repeat=200))
+
+        worker.close()
+
+
+@benchmark
+def bench_window_snapshot(results, size, databases, candidates=20, windows_per_process=3):
+    """Checking whether 20 candidate processes are minimized, on a fake window list
+
+    Walking the window list per process (what top_level_windows used to do)
+    vs one WindowSnapshot shared by every check.
+    """
+    for count in size["processes"]:
+        windows = [
+            utils.Window(0x10000 + i, 1000 + (i // windows_per_process) * 4, i % 5 != 0, i % 7 == 0, "x")
+            for i in range(count * windows_per_process)
+        ]
+        pids = [1000 + i * 4 for i in range(0, count, max(1, count // candidates))][:candidates]
+
+        def per_process():
+            for pid in pids:
+                utils.WindowSnapshot(lambda: windows).is_minimized(pid)
+
+        def shared():
+            snapshot = utils.WindowSnapshot(lambda: windows)
+            for pid in pids:
+                snapshot.is_minimized(pid)
+
+        results.add(f"window_snapshot/per_process/{count}", timeit(per_process, repeat=10))
+        results.add(f"window_snapshot/shared/{count}", timeit(shared, repeat=10))
+
+
+@benchmark
+def bench_matching(results, size, databases, rule_counts=(10, 100)):
+    """Matching a process table's names against substring, glob and regex rules
+
+    Trying each rule's own regex in turn vs the one combined matching.Matcher.
+    Like a real process table, about a quarter of the names are unique.
+    """
+    count = size["processes"][0]
+
+    for rule_count in rule_counts:
+        rules = [
+            matching.MatchRule(i, ("substring", "glob", "regex")[i % 3], pattern)
+            for i, pattern in enumerate(
+                (f"app{i}", f"tool{i}*.exe", rf"^svc{i}(host)?\d*\.exe$")[i % 3]
+                for i in range(rule_count)
+            )
+        ]
+        # a few hits so not every name falls through every rule
+        names = [
+            f"app{i % rule_count // 3 * 3}.exe" if i % 50 == 0 else f"process{i % (count // 4)}.exe"
+            for i in range(count)
+        ]
+
+        compiled = [(re.compile(rule.regex(), matching.FLAGS), rule) for rule in rules]
+        matcher = matching.Matcher(rules)
+
+        def one_by_one():
+            for name in names:
+                for regex, rule in compiled:
+                    if regex.fullmatch(name):
+                        break
+
+        def combined():
+            matcher._cache.clear()  # every run starts cold
+            for name in names:
+                matcher.match(name)
+
+        results.add(f"matching/one_by_one/{rule_count}/{count}", timeit(one_by_one, repeat=5))
+        results.add(f"matching/combined/{rule_count}/{count}", timeit(combined, repeat=5))
+
+
+@benchmark
+def bench_scheduler(results, size, databases, active_hours=8, mouse_timeout=10):
+    """Simulates a day (8 h active) with a fixed 0.5 s tick and with the AdaptiveScheduler
+
+    The clock is simulated, but the CPU cost of each tick is measured by running
+    Tracker.activity_tick (in foreground mode) on the synthetic source.
+    """
+    from scheduler import AdaptiveScheduler
+
+    source = synthetic_desktop(size["processes"][0])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        worker = start_worker(tmp)
+        tracker = headless_tracker(source, worker, "foreground")
+
+        def tick_cpu(repeat=2000):
+            start = time.process_time()
+            for _ in range(repeat):
+                tracker.activity_tick()
+            return (time.process_time() - start) / repeat
+
+        active_cost = tick_cpu()
+        source.set_idle(3600)
+        idle_cost = tick_cpu()
+
+        worker.close()
+
+    def simulate(next_interval):
+        clock = 0.0
+        idle_since = active_hours * 3600
+        wakeups = {"active": 0, "idle": 0}
+
+        while clock < 86400:
+            idle_time = max(0.0, clock - idle_since)
+            wakeups["idle" if idle_time > mouse_timeout else "active"] += 1
+            clock += next_interval(idle_time)
+
+        cpu = wakeups["active"] * active_cost + wakeups["idle"] * idle_cost
+        return wakeups["idle"] / (24 - active_hours), cpu
+
+    for name, next_interval in (
+        ("fixed", lambda idle_time: 0.5),
+        ("adaptive", AdaptiveScheduler(mouse_timeout).next_interval),
+    ):
+        wakeups, cpu = simulate(next_interval)
+        results.add(f"scheduler/{name}/idle_wakeups", wakeups, unit="wakeups/h")
+        results.add(f"scheduler/{name}/tick_cpu", cpu, unit="CPU-s/day")
+
+
+# == Writes ==
+
+
+@benchmark
+def bench_journal(results, size, databases, events=2000):
+    """Committing every start/stop vs the EntryJournal, on a file-backed db"""
+    import sqlalchemy
+    from sqlalchemy.orm import sessionmaker
+    import models
+    import migrations
+
+    def make_session(path):
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        sqlalchemy.event.listen(engine, "connect", migrations.set_pragmas)
+        models.Base.metadata.create_all(engine)
+        return sessionmaker(bind=engine)()
+
+    def switch_focus(start, stop):
+        for i in range(events // 2):
+            program_id = i % len(PROGRAM_NAMES) + 1
+            start(program_id)
+            stop(program_id)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # TimeEntry.start_logging/stop_logging use the module's session
+        original_session = models.session
+        models.session = make_session(os.path.join(tmp, "direct.db"))
+        try:
+            start = time.perf_counter()
+            switch_focus(models.TimeEntry.start_logging, models.TimeEntry.stop_logging)
+            direct = events / (time.perf_counter() - start)
+        finally:
+            models.session.close()
+            models.session = original_session
+
+        session = make_session(os.path.join(tmp, "journal.db"))
+        journal = models.EntryJournal(session)
+        start = time.perf_counter()
+        switch_focus(journal.start, journal.stop)
+        journal.flush()
+        journaled = events / (time.perf_counter() - start)
+        session.close()
+
+    results.add("writes/commit_each", direct, unit="events/s", better="higher")
+    results.add("writes/journal", journaled, unit="events/s", better="higher")
+
+
+@benchmark
+def bench_write_latency(results, size, databases, switches=20):
+    """Focus change to committed write through the DatabaseWorker (journal commits every event)"""
+    import sqlalchemy
+    from sqlalchemy.orm import sessionmaker
+    import models
+    import migrations
+    from dbworker import DatabaseWorker
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(tmp, 'latency.db')}")
+        sqlalchemy.event.listen(engine, "connect", migrations.set_pragmas)
+        models.Base.metadata.create_all(engine)
+
+        worker = DatabaseWorker(sessionmaker(bind=engine), max_events=1)
+        worker.start()
+
+        latencies = []
+        for i in range(switches):
+            start = time.perf_counter()
+            worker.start_logging(1)
+            worker.stop_logging(1).result()
+            latencies.append((time.perf_counter() - start) / 2)
+
+        worker.close()
+        engine.dispose()
+
+    results.add("writes/worker_latency", statistics.median(latencies))
+
+
+# == Reads ==
+
+
+@benchmark
+def bench_queries(results, size, databases):
+    """The queries the app runs all the time, on migrated databases"""
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    queries = {
+        "todays_entries": (
+            "SELECT * FROM time_entrys WHERE start_datetime >= ? ORDER BY end_datetime DESC",
+            (today.strftime("%Y-%m-%d %H:%M:%S.%f"),),
+        ),
+        "stop_lookup": (
+            "SELECT * FROM time_entrys WHERE program_id = ? AND end_datetime IS NULL "
+            "ORDER BY end_datetime DESC LIMIT 1",
+            (1,),
+        ),
+        "unfinished_entries": ("SELECT * FROM time_entrys WHERE end_datetime IS NULL", ()),
+        "daily_totals_today": (
+            "SELECT program_id, seconds FROM daily_totals WHERE day = ?",
+            (datetime.date.today().isoformat(),),
+        ),
+    }
+
+    for entries, programs in size["databases"]:
+        conn = sqlite3.connect(databases.get(entries, programs))
+        for name, (sql, params) in queries.items():
+            results.add(
+                f"queries/{name}/{entries}x{programs}",
+                timeit(lambda: conn.execute(sql, params).fetchall(), repeat=5),
+            )
+        conn.close()
+
+
+@benchmark
+def bench_todays_totals(results, size, databases):
+    """Today's per-program totals: the old per-program entry scan vs daily_totals
+
+    The old way is what MainDisplay.calculate_timedelta did, once per program.
+    """
+    import totals
+
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    today_str = today.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    for entries, programs in size["databases"]:
+        conn = sqlite3.connect(databases.get(entries, programs))
+
+        def entry_scan():
+            rows = conn.execute(
+                "SELECT program_id, start_datetime, end_datetime FROM time_entrys "
+                "WHERE start_datetime >= ?",
+                (today_str,),
+            ).fetchall()
+            rows = [
+                (p, totals.parse_datetime(s), totals.parse_datetime(e) if e else None)
+                for p, s, e in rows
+            ]
+            for program_id in range(1, programs + 1):
+                sum(
+                    ((e - s).total_seconds() for p, s, e in rows if p == program_id and e),
+                    0.0,
+                )
+
+        def rollup():
+            conn.execute(
+                "SELECT program_id, seconds FROM daily_totals WHERE day = ?",
+                (datetime.date.today().isoformat(),),
+            ).fetchall()
+
+        results.add(f"todays_totals/entry_scan/{entries}x{programs}", timeit(entry_scan, repeat=5))
+        results.add(f"todays_totals/daily_totals/{entries}x{programs}", timeit(rollup, repeat=5))
+        conn.close()
+
+
+@benchmark
+def bench_timestamps(results, size, databases, days=30):
+    """ISO text timestamps vs integer epoch milliseconds (see timestamps.py)
+
+    File size after a vacuum, a range filter over the last 30 days, parsing
+    those entries into datetimes, and summing every duration in SQL.
+    """
+    import sqlalchemy
+    import timestamps
+
+    for entries, programs in size["databases"]:
+        source = databases.get(entries, programs)
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+        for format in ("iso", "epoch_ms"):
+            path = os.path.join(databases.folder, f"{entries}x{programs}-{format}.db")
+            shutil.copy(source, path)
+
+            engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+            timestamps.load(engine)  # the copy is iso
+            timestamps.convert(engine, format)
+            with engine.connect() as conn:
+                conn.exec_driver_sql("VACUUM")
+            engine.dispose()
+
+            conn = sqlite3.connect(path)
+            bound = timestamps.to_db(since)
+            duration = timestamps.duration_sql("start_datetime", "end_datetime")
+
+            def range_filter():
+                conn.execute(
+                    "SELECT COUNT(*) FROM time_entrys WHERE start_datetime >= ?", (bound,)
+                ).fetchone()
+
+            def parse():
+                for start, end in conn.execute(
+                    "SELECT start_datetime, end_datetime FROM time_entrys WHERE start_datetime >= ?",
+                    (bound,),
+                ):
+                    timestamps.from_db(start), timestamps.from_db(end)
+
+            def sum_durations():
+                conn.execute(
+                    f"SELECT program_id, SUM({duration}) FROM time_entrys "
+                    "WHERE end_datetime IS NOT NULL GROUP BY program_id"
+                ).fetchall()
+
+            label = f"{format}/{entries}x{programs}"
+            results.add(f"timestamps/file_size/{label}", os.path.getsize(path) / 1024 ** 2, unit="MiB")
+            results.add(f"timestamps/range_filter/{label}", timeit(range_filter, repeat=5))
+            results.add(f"timestamps/parse/{label}", timeit(parse, repeat=5))
+            results.add(f"timestamps/sum_durations/{label}", timeit(sum_durations, repeat=3))
+
+            conn.close()
+            os.remove(path)
+
+        timestamps.format = "iso"
+
+
+@benchmark
+def bench_report(results, size, databases):
+    """A year's report grouped by week and program"""
+    import sqlalchemy
+    import reports
+
+    start = datetime.date.today() - datetime.timedelta(days=365)
+
+    for entries, programs in size["databases"]:
+        engine = sqlalchemy.create_engine(f"sqlite:///{databases.get(entries, programs)}")
+        with engine.connect() as conn:
+            results.add(
+                f"report/year_by_week_program/{entries}x{programs}",
+                timeit(
+                    lambda: reports.report(conn, start, datetime.date.today(), ("week", "program")),
+                    repeat=5,
+                ),
+            )
+        engine.dispose()
+
+
+# == Startup ==
+
+STARTUP_SCRIPT = """
+import datetime, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {path!r})
+import models
+models.init_db()
+programs = models.session.query(models.Program).all()
+models.DailyTotal.get_day(datetime.date.today())
+models.TimeEntry.close_unfinished_entries()
+print(time.perf_counter() - start)
+"""
+
+
+@benchmark
+def bench_startup(results, size, databases):
+    """Setting up the db, and loading programs and today's totals, in a new process"""
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    for entries, programs in size["databases"]:
+        source = databases.get(entries, programs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "data"))
+
+            def run():
+                # a fresh copy each time, since startup closes the open entry
+                with open(source, "rb") as src, open(os.path.join(tmp, "data", "timedata.db"), "wb") as dst:
+                    while True:
+                        chunk = src.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+
+                output = subprocess.check_output(
+                    [sys.executable, "-c", STARTUP_SCRIPT.format(path=here)],
+                    cwd=tmp,
+                    stderr=subprocess.DEVNULL,
+                )
+                return float(output.decode().strip().splitlines()[-1])
+
+            results.add(
+                f"startup/load/{entries}x{programs}",
+                statistics.median(run() for _ in range(3)),
+            )
+
+
+# == Running ==
+
+
+def compare(current, baseline, threshold):
+    """Returns a list of (name, baseline value, current value) for metrics that regressed"""
+    regressions = []
+
+    for name, metric in current["results"].items():
+        old = baseline["results"].get(name)
+        if not old or not old["value"]:
+            continue
+
+        new_value, old_value = metric["value"], old["value"]
+        if metric["better"] == "lower":
+            regressed = new_value > old_value * (1 + threshold)
+        else:
+            regressed = new_value < old_value * (1 - threshold)
+
+        if regressed:
+            regressions.append((name, old_value, new_value))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for TimeTracker's hot paths")
+    parser.add_argument("--size", choices=SIZES, default="quick", help="Defaults to quick")
+    parser.add_argument("--only", help="Only run benchmarks matching this glob (e.g. 'queries*')")
+    parser.add_argument("--output", "-o", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="A previous results file to check for regressions against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="How much worse (as a fraction) a metric can get before it's flagged. Defaults to 0.25",
+    )
+    args = parser.parse_args(argv)
+
+    size = SIZES[args.size]
+    results = Results()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        databases = Databases(tmp)
+        for name, func in BENCHMARKS:
+            if args.only and not fnmatch.fnmatch(name, args.only):
+                continue
+
+            print(f"{name}:")
+            func(results, size, databases)
+
+    output = results.to_json(args.size)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+        print(f"Saved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(output, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for name, old, new in regressions:
+                print(f"  {name}: {old:.6g} -> {new:.6g}")
+            return 1
+
+        print(f"No regressions beyond {args.threshold:.0%}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
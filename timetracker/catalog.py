@@ -0,0 +1,141 @@
+"""MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import collections
+import threading
+import queue
+import logging
+import time
+
+
+log = logging.getLogger("timetracker.catalog")
+
+
+ProcessInfo = collections.namedtuple("ProcessInfo", "name pid exe")
+
+
+class ProcessCatalog:
+    """Lists running processes for the add program dialog without blocking the GUI
+
+    Listing processes means asking the OS about every one of them, which
+    can take seconds. :meth:`scan` does it on a background thread and hands
+    the results over in batches through a queue, so the dialog can fill in
+    as they arrive. Finished listings are kept for ``max_age`` seconds and
+    reused, so opening the dialog again is instant.
+
+    By default only processes that own a visible window are listed, since
+    those are the ones people want to track.
+    """
+
+    def __init__(self, source, max_age=60.0, batch_size=20):
+        self.source = source
+        self.max_age = max_age
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._snapshots = {}  # windowed_only: (monotonic time, [ProcessInfo])
+        self._scans = {}  # windowed_only: (found so far, [subscriber queues])
+
+    def scan(self, windowed_only=True):
+        """Starts listing processes, or reuses a recent listing
+
+        Returns a :class:`queue.Queue` that receives lists of :class:`ProcessInfo`
+        (one process per name), followed by None once the listing is done.
+        """
+        results = queue.Queue()
+
+        with self._lock:
+            snapshot = self._snapshots.get(windowed_only)
+            if snapshot and time.monotonic() - snapshot[0] < self.max_age:
+                results.put(list(snapshot[1]))
+                results.put(None)
+                return results
+
+            scan = self._scans.get(windowed_only)
+            if scan:
+                # one's already running. catch up on what it's found so far
+                found, subscribers = scan
+                if found:
+                    results.put(list(found))
+                subscribers.append(results)
+                return results
+
+            self._scans[windowed_only] = ([], [results])
+
+        thread = threading.Thread(target=self._scan, args=(windowed_only,), name="timetracker-catalog")
+        thread.daemon = True
+        thread.start()
+        return results
+
+    def invalidate(self):
+        """Throws away the cached listings"""
+        with self._lock:
+            self._snapshots.clear()
+
+    def _scan(self, windowed_only):
+        start = time.perf_counter()
+        seen = set()
+        batch = []
+
+        try:
+            pids = self.source.visible_window_pids(fresh=True) if windowed_only else None
+
+            for pid, name, exe in self.source.iter_process_info():
+                if pids is not None and pid not in pids:
+                    continue
+
+                if name in seen:
+                    continue
+                seen.add(name)
+
+                batch.append(ProcessInfo(name, pid, exe))
+                if len(batch) >= self.batch_size:
+                    self._publish(windowed_only, batch)
+                    batch = []
+
+        except Exception:
+            log.exception("Failed to list processes")
+
+        self._publish(windowed_only, batch)
+
+        with self._lock:
+            found, subscribers = self._scans.pop(windowed_only)
+            self._snapshots[windowed_only] = (time.monotonic(), found)
+
+            for subscriber in subscribers:
+                subscriber.put(None)
+
+        log.info(f"Listed {len(found)} processes in {time.perf_counter() - start:.3f}s")
+
+    def _publish(self, windowed_only, batch):
+        if not batch:
+            return
+
+        # under the lock, so a subscriber that's catching up can't get a batch twice
+        with self._lock:
+            found, subscribers = self._scans[windowed_only]
+            found.extend(batch)
+
+            for subscriber in subscribers:
+                subscriber.put(batch)
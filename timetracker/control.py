@@ -0,0 +1,407 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# The control channel: a small line-based JSON protocol on localhost that
+# other processes (a second instance, scripts, status bar widgets) use to
+# talk to the running app.
+#
+# Every request is one line of JSON: {"token": "...", "command": "status"},
+# with an optional "args" object. The token is a per-install secret in
+# data/control_token that only the user can read, so other users and web pages
+# can't drive the tracker. A connection is closed on its first line that isn't
+# a valid request with the right token.
+# Every response is one line of JSON: {"ok": true, "result": ...} or
+# {"ok": false, "error": "..."}. Requests on one connection are answered in order.
+#
+# Like instance.py, this only imports from the standard library, since the
+# client side runs in processes that exit straight away.
+
+import collections
+import concurrent.futures
+import hmac
+import json
+import logging
+import os
+import secrets
+import selectors
+import socket
+import sys
+import threading
+import time
+
+ADDRESS = ("localhost", 8320)
+TOKEN_FILE = os.path.join("data", "control_token")
+
+# a client sending more than this without a newline is dropped
+MAX_LINE = 64 * 1024
+# and so is one that stops reading its responses
+MAX_PENDING_OUTPUT = 1024 * 1024
+
+
+log = logging.getLogger("timetracker.control")
+
+
+class ControlError(Exception):
+    """Raised by the client when the server answers with an error"""
+
+
+class BadRequest(Exception):
+    """A request line that isn't valid JSON with the right token"""
+
+
+def load_token(path=TOKEN_FILE, create=False):
+    """Returns the control token, creating it (readable by the user only) if ``create`` is set"""
+    if create and not os.path.isfile(path):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass  # another process just made it
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+
+    if create and sys.platform != "win32":
+        os.chmod(path, 0o600)
+
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+class Connection:
+    """A client's socket and its buffers"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.input = bytearray()
+        self.output = bytearray()
+
+        # responses in request order. an item is None until its future finishes
+        self.responses = collections.deque()
+
+
+class ControlServer(threading.Thread):
+    """Serves the control channel on a single thread with :mod:`selectors`
+
+    Requests must carry ``token``. ``handlers`` maps each command to a function that's called with the
+    request's ``args`` as keyword arguments. Handlers run on the server thread,
+    so they must be quick. If one has to wait on something (the db worker,
+    the Tk thread), it should return a :class:`concurrent.futures.Future`
+    instead. The response is sent once it's done, and other clients are
+    served in the meantime.
+    """
+
+    def __init__(self, handlers, token, address=ADDRESS):
+        threading.Thread.__init__(self, name="timetracker-control")
+        self.daemon = True  # close the thread when the app is destroyed
+
+        self.token = token
+        self.handlers = dict(handlers)
+        self.handlers.setdefault("help", lambda: sorted(self.handlers))
+
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if sys.platform != "win32":
+            # lets a restarted app bind while old connections are in TIME_WAIT.
+            # on Windows this would let another process take the port
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+        # futures finish on other threads, so they wake the selector up through this
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+        self._wake()
+
+    def run(self):
+        log.info(f"Control server listening on {self.address[0]}:{self.address[1]}")
+
+        while not self._closed:
+            for key, events in self.selector.select():
+                if key.fileobj is self.listener:
+                    self._accept()
+                elif key.fileobj is self._wakeup_read:
+                    self._drain_wakeups()
+                else:
+                    if events & selectors.EVENT_READ:
+                        self._read(key.data)
+                    if events & selectors.EVENT_WRITE and key.data in self.connections:
+                        self._write(key.data)
+
+        for conn in list(self.connections):
+            self._drop(conn)
+
+        self.selector.close()
+        self.listener.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+        log.info("Control server stopped")
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except BlockingIOError:
+            return
+
+        sock.setblocking(False)
+        conn = Connection(sock, address)
+        self.connections.add(conn)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self._drop(conn)
+            return
+
+        conn.input += data
+        while True:
+            line, sep, rest = conn.input.partition(b"\n")
+            if not sep:
+                break
+
+            conn.input = bytearray(rest)
+            try:
+                command, args = parse_request(bytes(line), self.token)
+            except BadRequest as e:
+                log.warning(f"Dropping {conn.address}: {e}")
+                self._drop(conn)
+                return
+
+            self._dispatch(conn, command, args)
+
+        if len(conn.input) > MAX_LINE:
+            log.warning(f"Dropping {conn.address}: request line too long")
+            self._drop(conn)
+
+    def _dispatch(self, conn, command, args):
+        slot = [None]
+        conn.responses.append(slot)
+
+        try:
+            handler = self.handlers.get(command)
+            if handler is None:
+                raise ControlError(f"Unknown command {command!r}")
+
+            result = handler(**args)
+
+        except Exception as e:
+            slot[0] = error_response(e)
+
+        else:
+            if isinstance(result, concurrent.futures.Future):
+                result.add_done_callback(lambda future: self._future_done(conn, slot, future))
+                return
+
+            slot[0] = {"ok": True, "result": result}
+
+        self._queue_responses(conn)
+
+    def _future_done(self, conn, slot, future):
+        # runs on whichever thread finished the future
+        try:
+            slot[0] = {"ok": True, "result": future.result()}
+        except Exception as e:
+            slot[0] = error_response(e)
+
+        self._wake()
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_read.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        for conn in list(self.connections):
+            self._queue_responses(conn)
+
+    def _queue_responses(self, conn):
+        """Moves finished responses (in order) into the output buffer"""
+        if conn not in self.connections:
+            return
+
+        while conn.responses and conn.responses[0][0] is not None:
+            response = conn.responses.popleft()[0]
+            conn.output += json.dumps(response, default=str).encode() + b"\n"
+
+        if len(conn.output) > MAX_PENDING_OUTPUT:
+            log.warning(f"Dropping {conn.address}: it isn't reading its responses")
+            self._drop(conn)
+            return
+
+        if conn.output:
+            self._write(conn)
+
+    def _write(self, conn):
+        try:
+            sent = conn.sock.send(conn.output)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._drop(conn)
+            return
+
+        del conn.output[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.output else 0)
+        self.selector.modify(conn.sock, events, conn)
+
+    def _drop(self, conn):
+        self.connections.discard(conn)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already has a wakeup pending, or closed
+
+
+def parse_request(line, token):
+    """Returns (command, args) for a request line. Raises :class:`BadRequest` if it isn't valid"""
+    try:
+        request = json.loads(line)
+    except ValueError:
+        raise BadRequest("request isn't JSON") from None
+
+    if not isinstance(request, dict):
+        raise BadRequest("request isn't an object")
+
+    given = request.get("token")
+    if not isinstance(given, str) or not hmac.compare_digest(given.encode(), token.encode()):
+        raise BadRequest("wrong or missing token")
+
+    command = request.get("command")
+    args = request.get("args") or {}
+    if not isinstance(command, str) or not isinstance(args, dict):
+        raise BadRequest("command must be a string and args an object")
+
+    return command, args
+
+
+def error_response(e):
+    if not isinstance(e, ControlError):
+        log.exception("Control command failed", exc_info=e)
+    return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+
+class ControlClient:
+    """A connection to the control server. Keep one open to poll cheaply"""
+
+    def __init__(self, address=ADDRESS, timeout=5, token=None):
+        self.token = token if token is not None else load_token()
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.file = self.sock.makefile("rb")
+
+    def send(self, command, **args):
+        """Sends a command and returns its result. Raises :class:`ControlError` on errors"""
+        request = {"token": self.token, "command": command, "args": args}
+        self.sock.sendall(json.dumps(request).encode() + b"\n")
+
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The control server closed the connection")
+
+        response = json.loads(line)
+        if not response["ok"]:
+            raise ControlError(response["error"])
+
+        return response["result"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def send_command(command, address=ADDRESS, timeout=5, token=None, **args):
+    """Connects, sends one command and returns its result"""
+    with ControlClient(address, timeout, token) as client:
+        return client.send(command, **args)
+
+
+COMMANDS = ("status", "current_program", "today_totals", "pause", "resume", "flush", "open_gui", "stop",
+            "metrics", "dump_metrics", "match_rules", "retention", "help")
+
+
+def add_arguments(parser):
+    parser.add_argument("action", help=f"The command to send. One of: {', '.join(COMMANDS)}")
+    parser.add_argument(
+        "--watch",
+        type=float,
+        metavar="SECONDS",
+        help="Keep sending the command every SECONDS seconds over one connection",
+    )
+
+
+def run(args):
+    try:
+        client = ControlClient()
+    except FileNotFoundError:
+        print(f"No control token at {TOKEN_FILE}, run this from TimeTracker's folder", file=sys.stderr)
+        sys.exit(1)
+    except OSError:
+        print("TimeTracker isn't running (or isn't reachable)", file=sys.stderr)
+        sys.exit(1)
+
+    with client:
+        while True:
+            try:
+                result = client.send(args.action)
+            except ControlError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+
+            print(json.dumps(result, indent=None if args.watch else 4, sort_keys=True), flush=True)
+
+            if not args.watch:
+                break
+            time.sleep(args.watch)
@@ -0,0 +1,156 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import threading
+import queue
+import logging
+import time
+import concurrent.futures
+
+from models import EntryJournal
+from titles import TitleInterner
+import metrics
+
+
+log = logging.getLogger("timetracker.dbworker")
+
+
+class DatabaseWorker(threading.Thread):
+    """A thread that owns a session and runs every database call on it
+
+    Calls are submitted with :meth:`submit`, which returns a
+    :class:`concurrent.futures.Future` straight away, so nothing that submits
+    work ever waits on the Tk event loop (or on the db, unless it wants to).
+
+    The worker also owns the :class:`models.EntryJournal` that buffers time
+    entry writes, and the :class:`titles.TitleInterner` that turns window titles
+    into ids for it. Between requests it sleeps until the journal's next flush or
+    heartbeat is due (for as long as it takes when neither is), flushing the
+    journal once it's old enough and sending the running entry's heartbeat.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        max_events=50,
+        max_age=30.0,
+        heartbeat_interval=60.0,
+        title_cache_size=1024,
+    ):
+        threading.Thread.__init__(self, name="timetracker-db")
+        self.daemon = True  # close the thread when the app is destroyed
+
+        self.session = session_factory()
+        self.journal = EntryJournal(
+            self.session,
+            max_events=max_events,
+            max_age=max_age,
+            heartbeat_interval=heartbeat_interval,
+            titles=TitleInterner(self.session, title_cache_size),
+        )
+        self.requests = queue.Queue()
+
+    def submit(self, callable, *args, **kwargs):
+        """Runs callable(session, *args, **kwargs) on the worker thread
+
+        Returns a :class:`concurrent.futures.Future` for the result.
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((future, callable, args, kwargs, time.perf_counter()))
+        return future
+
+    def start_logging(self, program_id, title=None):
+        """Starts a time entry. The future's result is the new entry"""
+        return self.submit(lambda session: self.journal.start(program_id, title))
+
+    def stop_logging(self, program_id):
+        """Stops a time entry. The future's result is the finished entry"""
+        return self.submit(lambda session: self.journal.stop(program_id))
+
+    def flush(self):
+        """Commits the journal. The future's result is the number of changes written"""
+        return self.submit(lambda session: self.journal.flush())
+
+    def close(self, timeout=10):
+        """Flushes the journal and stops the thread"""
+        if not self.is_alive():
+            return
+
+        future = self.flush()
+        self.requests.put(None)
+
+        try:
+            future.result(timeout)
+        except Exception:
+            log.exception("Failed to flush time entries on close")
+
+        self.join(timeout)
+
+    def run(self):
+        log.info("Database worker started")
+
+        while True:
+            try:
+                request = self.requests.get(timeout=self.journal.seconds_until_due())
+            except queue.Empty:
+                self._run_safely(self.journal.heartbeat_if_due)
+                self._run_safely(self.journal.flush_if_due)
+                continue
+
+            if request is None:
+                break
+
+            future, callable, args, kwargs, submitted_at = request
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started_at = time.perf_counter()
+            metrics.registry.observe("db.queue_wait", started_at - submitted_at)
+
+            try:
+                result = callable(self.session, *args, **kwargs)
+            except BaseException as e:
+                # the journal's buffer isn't in the session, so it's left alone
+                self.session.rollback()
+                metrics.registry.increment("db.errors")
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+            finished_at = time.perf_counter()
+            metrics.registry.observe("db.call", finished_at - started_at)
+            metrics.registry.observe("db.round_trip", finished_at - submitted_at)
+
+            self._run_safely(self.journal.heartbeat_if_due)
+            self._run_safely(self.journal.flush_if_due)
+
+        self.session.close()
+        log.info("Database worker stopped")
+
+    def _run_safely(self, callable):
+        try:
+            callable()
+        except Exception:
+            # the journal cleans up after itself (and keeps its changes if it can retry)
+            log.exception(f"Database worker failed to run {callable}")
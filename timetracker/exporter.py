@@ -0,0 +1,309 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import array
+import csv
+import datetime
+import json
+import struct
+import sys
+import logging
+
+import sqlalchemy
+
+import totals
+from timestamps import Timestamp
+
+
+log = logging.getLogger("timetracker.exporter")
+
+FORMATS = ("csv", "jsonl", "binary")
+CHUNK_SIZE = 5000
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The binary format is little-endian throughout:
+#
+#   b"TTX2"
+#   uint32 program count, then for each program:
+#       int32 id, then the name and each of PROGRAM_COLUMNS but capture_titles as
+#       uint16 length + utf-8 (a length of 0xFFFF is NULL), then uint8 capture_titles
+#   blocks, each:
+#       uint32 row count (0 marks the end of the file)
+#       int64[count] entry ids
+#       int32[count] program ids (-1 if the program was deleted)
+#       int64[count] start, ms since the epoch (UTC)
+#       int64[count] end, ms since the epoch (UTC), -1 if still running
+BINARY_MAGIC = b"TTX2"
+NULL_LENGTH = 0xFFFF
+
+# what the importer needs to recreate a program that matches the same processes
+PROGRAM_COLUMNS = ("process_name", "location", "match_type", "match_pattern", "capture_titles")
+
+
+def to_epoch_ms(value):
+    """Converts a naive UTC datetime (or the string SQLite stores) to ms since the epoch"""
+    return (totals.parse_datetime(value) - EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def iter_entries(conn, start=None, end=None, program=None, chunk_size=CHUNK_SIZE):
+    """Yields lists of entry rows, ``chunk_size`` at a time
+
+    Each row is (id, program_id, program name, *PROGRAM_COLUMNS, start, end),
+    with the program's columns joined in. The rows come straight off the cursor,
+    so only one chunk is ever held in memory.
+    ``start`` and ``end`` are UTC datetimes; ``end`` is exclusive.
+    """
+    sql = (
+        "SELECT e.id, e.program_id, p.name, "
+        + "".join(f"p.{column}, " for column in PROGRAM_COLUMNS)
+        + "e.start_datetime, e.end_datetime "
+        "FROM time_entrys e LEFT JOIN programs p ON p.id = e.program_id "
+        "WHERE 1 = 1"
+    )
+    # Timestamp so the values are stored the same way the entries are
+    params = []
+
+    if start:
+        sql += " AND e.start_datetime >= :start"
+        params.append(sqlalchemy.bindparam("start", start, type_=Timestamp))
+    if end:
+        sql += " AND e.start_datetime < :end"
+        params.append(sqlalchemy.bindparam("end", end, type_=Timestamp))
+    if program:
+        sql += " AND p.name = :program"
+        params.append(sqlalchemy.bindparam("program", program))
+
+    sql += " ORDER BY e.start_datetime"
+
+    result = conn.execution_options(stream_results=True).execute(
+        sqlalchemy.text(sql).bindparams(*params)
+    )
+
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def write_csv(chunks, output):
+    writer = csv.writer(output)
+    writer.writerow(["id", "program_id", "program", *PROGRAM_COLUMNS, "start_utc", "end_utc", "seconds"])
+
+    for rows in chunks:
+        for id, program_id, name, *program, start, end in rows:
+            start = totals.parse_datetime(start)
+            end = totals.parse_datetime(end) if end else None
+            seconds = f"{(end - start).total_seconds():.3f}" if end else ""
+            writer.writerow([
+                id, program_id, name, *program,
+                start.isoformat(), end.isoformat() if end else "", seconds,
+            ])
+
+
+def write_jsonl(chunks, output):
+    for rows in chunks:
+        lines = []
+        for id, program_id, name, *program, start, end in rows:
+            start = totals.parse_datetime(start)
+            end = totals.parse_datetime(end) if end else None
+            lines.append(json.dumps({
+                "id": id,
+                "program_id": program_id,
+                "program": name,
+                **dict(zip(PROGRAM_COLUMNS, program)),
+                "start_utc": start.isoformat(),
+                "end_utc": end.isoformat() if end else None,
+                "seconds": (end - start).total_seconds() if end else None,
+            }))
+
+        output.write("\n".join(lines))
+        output.write("\n")
+
+
+def write_binary(chunks, output, programs):
+    """Writes the compact columnar format described at the top of this module
+
+    ``programs`` maps program ids to dicts of their name and PROGRAM_COLUMNS.
+    """
+
+    def write_array(typecode, values):
+        column = array.array(typecode, values)
+        if sys.byteorder != "little":
+            column.byteswap()
+        output.write(column.tobytes())
+
+    output.write(BINARY_MAGIC)
+    def write_string(value):
+        if value is None:
+            output.write(struct.pack("<H", NULL_LENGTH))
+            return
+
+        encoded = value.encode("utf-8")
+        output.write(struct.pack("<H", len(encoded)))
+        output.write(encoded)
+
+    output.write(struct.pack("<I", len(programs)))
+    for id, program in programs.items():
+        output.write(struct.pack("<i", id))
+        write_string(program["name"])
+        for column in PROGRAM_COLUMNS[:-1]:
+            write_string(program[column])
+        output.write(struct.pack("<B", bool(program["capture_titles"])))
+
+    for rows in chunks:
+        output.write(struct.pack("<I", len(rows)))
+        write_array("q", (r[0] for r in rows))
+        write_array("i", (r[1] if r[1] is not None else -1 for r in rows))
+        write_array("q", (to_epoch_ms(r[-2]) for r in rows))
+        write_array("q", (to_epoch_ms(r[-1]) if r[-1] else -1 for r in rows))
+
+    output.write(struct.pack("<I", 0))
+
+
+def read_binary(file):
+    """Reads the binary format back, yielding (id, program_id, program, start, end)
+
+    ``program`` is a dict of the program's name and PROGRAM_COLUMNS (None if it
+    was deleted). ``start`` and ``end`` are naive UTC datetimes (``end`` is None
+    for running entries).
+    """
+
+    def read_array(typecode, count):
+        column = array.array(typecode)
+        column.frombytes(file.read(column.itemsize * count))
+        if sys.byteorder != "little":
+            column.byteswap()
+        return column
+
+    if file.read(4) != BINARY_MAGIC:
+        raise ValueError("Not a TimeTracker export")
+
+    def read_string():
+        (length,) = struct.unpack("<H", file.read(2))
+        if length == NULL_LENGTH:
+            return None
+        return file.read(length).decode("utf-8")
+
+    (program_count,) = struct.unpack("<I", file.read(4))
+    programs = {}
+    for _ in range(program_count):
+        (id,) = struct.unpack("<i", file.read(4))
+        program = {"name": read_string()}
+        for column in PROGRAM_COLUMNS[:-1]:
+            program[column] = read_string()
+        program["capture_titles"] = bool(file.read(1)[0])
+        programs[id] = program
+
+    def to_datetime(ms):
+        return EPOCH + datetime.timedelta(milliseconds=ms)
+
+    while True:
+        (count,) = struct.unpack("<I", file.read(4))
+        if not count:
+            break
+
+        ids = read_array("q", count)
+        program_ids = read_array("i", count)
+        starts = read_array("q", count)
+        ends = read_array("q", count)
+
+        for id, program_id, start, end in zip(ids, program_ids, starts, ends):
+            program_id = program_id if program_id != -1 else None
+            yield (
+                id,
+                program_id,
+                programs.get(program_id),
+                to_datetime(start),
+                to_datetime(end) if end != -1 else None,
+            )
+
+
+def export(conn, format, output, start=None, end=None, program=None):
+    """Streams the time entries to ``output`` in one of :data:`FORMATS`
+
+    ``output`` should be a text file for csv/jsonl and a binary file for binary.
+    """
+    chunks = iter_entries(conn, start, end, program)
+
+    if format == "csv":
+        write_csv(chunks, output)
+    elif format == "jsonl":
+        write_jsonl(chunks, output)
+    elif format == "binary":
+        result = conn.execute(
+            sqlalchemy.text(f"SELECT id, name, {', '.join(PROGRAM_COLUMNS)} FROM programs")
+        )
+        programs = {row.id: dict(row._mapping) for row in result}
+        write_binary(chunks, output, programs)
+    else:
+        raise ValueError(f"Unknown export format '{format}'")
+
+
+def add_arguments(parser):
+    """Adds the export subcommand's arguments to an argparse parser"""
+    parser.add_argument("--format", choices=FORMATS, default="csv", help="Defaults to csv")
+    parser.add_argument(
+        "--from",
+        dest="start",
+        type=datetime.date.fromisoformat,
+        help="Only entries that started on or after this day (YYYY-MM-DD, local time)",
+    )
+    parser.add_argument(
+        "--to",
+        dest="end",
+        type=datetime.date.fromisoformat,
+        help="Only entries that started on or before this day (YYYY-MM-DD, local time)",
+    )
+    parser.add_argument("--program", help="Only include the program with this name")
+    parser.add_argument("--output", "-o", help="File to write to. Defaults to stdout")
+
+
+def local_day_to_utc(day):
+    """Returns local midnight at the start of a day as a naive UTC datetime"""
+    local = datetime.datetime.combine(day, datetime.time()).astimezone()
+    return local.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def run(args, engine):
+    """Runs the export subcommand"""
+    start = local_day_to_utc(args.start) if args.start else None
+    end = local_day_to_utc(args.end + datetime.timedelta(days=1)) if args.end else None
+    binary = args.format == "binary"
+
+    if args.output:
+        if binary:
+            output = open(args.output, "wb")
+        else:
+            output = open(args.output, "w", encoding="utf-8", newline="")
+    else:
+        output = sys.stdout.buffer if binary else sys.stdout
+
+    try:
+        with engine.connect() as conn:
+            export(conn, args.format, output, start, end, args.program)
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,217 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import csv
+import datetime
+import json
+import time
+import logging
+
+import matching
+import totals
+import timestamps
+
+
+log = logging.getLogger("timetracker.importer")
+
+FORMATS = ("csv", "jsonl")
+BATCH_SIZE = 10000
+TRANSACTION_SIZE = 250000
+
+# how SQLAlchemy's DateTime stores values in SQLite (programs.added_at).
+# time entries are stored in the db's timestamps.format instead
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp into a naive UTC datetime
+
+    Timestamps without an offset are assumed to already be in UTC.
+    """
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def parse_bool(value):
+    """Reads a boolean that's either from JSON or a CSV cell ("True", "1", "")"""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+def read_csv(file):
+    yield from csv.DictReader(file)
+
+
+def read_jsonl(file):
+    for line in file:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None  # counted as skipped
+
+
+def import_entries(raw_conn, records, batch_size=BATCH_SIZE, transaction_size=TRANSACTION_SIZE):
+    """Bulk inserts time entries from an iterable of dicts
+
+    Each record needs a ``program`` (the program's name), ``start_utc`` and
+    ``end_utc``. When a program has to be created, its ``process_name``,
+    ``location``, ``match_type``, ``match_pattern`` and ``capture_titles``
+    are restored too, so it matches processes the same way it did when it
+    was exported.
+    This is the format :mod:`exporter` writes. Records without an end
+    are skipped, since they were still running when they were exported, and
+    so are records that can't be parsed.
+
+    ``raw_conn`` is a DBAPI connection (``engine.raw_connection()``). Entries
+    are inserted with executemany in batches, committing every ``transaction_size``
+    rows. Each transaction also adds its entries to the daily totals, so an
+    import that fails part way leaves them matching the entries it committed.
+
+    Returns a tuple of (entries imported, programs created, rows skipped).
+    """
+    cursor = raw_conn.cursor()
+
+    program_ids = dict(cursor.execute("SELECT name, id FROM programs").fetchall())
+    created = 0
+    skipped = 0
+    imported = 0
+    since_commit = 0
+
+    day_totals = {}  # (day, program_id): seconds
+    batch = []
+
+    def flush_batch():
+        cursor.executemany(
+            "INSERT INTO time_entrys (program_id, start_datetime, end_datetime) VALUES (?, ?, ?)",
+            batch,
+        )
+        batch.clear()
+
+    def commit():
+        if batch:
+            flush_batch()
+
+        cursor.executemany(
+            "INSERT INTO daily_totals (day, program_id, seconds) VALUES (?, ?, ?) "
+            "ON CONFLICT (day, program_id) DO UPDATE SET seconds = seconds + excluded.seconds",
+            [(day, program_id, seconds) for (day, program_id), seconds in day_totals.items()],
+        )
+        day_totals.clear()
+        raw_conn.commit()
+
+    for record in records:
+        try:
+            name = record["program"]
+            start = parse_timestamp(record["start_utc"])
+            end = parse_timestamp(record["end_utc"]) if record.get("end_utc") else None
+        except (KeyError, TypeError, ValueError, AttributeError):
+            # missing fields, malformed lines, or short CSV rows (which give None)
+            skipped += 1
+            continue
+
+        if not name or end is None or end < start:
+            skipped += 1
+            continue
+
+        program_id = program_ids.get(name)
+        if program_id is None:
+            match_type = record.get("match_type")
+            cursor.execute(
+                "INSERT INTO programs "
+                "(name, process_name, location, match_type, match_pattern, capture_titles, added_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    name,
+                    record.get("process_name") or name,
+                    record.get("location") or "",
+                    match_type if match_type in matching.MATCH_TYPES else None,
+                    record.get("match_pattern") or None,
+                    parse_bool(record.get("capture_titles")),
+                    datetime.datetime.utcnow().strftime(DATETIME_FORMAT),
+                ),
+            )
+            program_id = program_ids[name] = cursor.lastrowid
+            created += 1
+
+        batch.append((program_id, timestamps.to_db(start), timestamps.to_db(end)))
+
+        for day, seconds in totals.split_by_day(start, end):
+            key = (day.isoformat(), program_id)
+            day_totals[key] = day_totals.get(key, 0.0) + seconds
+
+        imported += 1
+        since_commit += 1
+
+        if len(batch) >= batch_size:
+            flush_batch()
+
+        if since_commit >= transaction_size:
+            commit()
+            since_commit = 0
+
+    commit()
+    cursor.close()
+
+    return imported, created, skipped
+
+
+def add_arguments(parser):
+    """Adds the import subcommand's arguments to an argparse parser"""
+    parser.add_argument("file", help="A CSV or JSON Lines file, like the ones export writes")
+    parser.add_argument(
+        "--format", choices=FORMATS, help="Defaults to guessing from the file extension"
+    )
+
+
+def run(args, engine):
+    """Runs the import subcommand"""
+    format = args.format or ("jsonl" if args.file.lower().endswith((".jsonl", ".json")) else "csv")
+    reader = read_jsonl if format == "jsonl" else read_csv
+
+    raw_conn = engine.raw_connection()
+    start = time.perf_counter()
+
+    try:
+        with open(args.file, "r", encoding="utf-8", newline="") as f:
+            imported, created, skipped = import_entries(raw_conn, reader(f))
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+    elapsed = time.perf_counter() - start
+    rate = imported / elapsed if elapsed else 0
+    log.info(
+        f"Imported {imported} entries ({created} new programs, {skipped} rows skipped) "
+        f"in {elapsed:.1f}s, {rate:.0f} rows/sec"
+    )
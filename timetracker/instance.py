@@ -0,0 +1,89 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Single instance helpers. Talking to the running instance is done
+# through the control channel (see control.py).
+#
+# A second instance imports this and exits straight away,
+# so it should only import from the standard library at the top.
+
+import os
+import tempfile
+
+LOCKFILE = os.path.normpath(tempfile.gettempdir() + '/timetracker_instance.lock')
+
+# the lockfile holds the owner's PID, followed by this if it's a maintenance
+# command (like --convert-timestamps) rather than the app
+MAINTENANCE = "maintenance"
+
+
+def write_pid(mode=None):
+    """Writes the app's PID (and ``mode``, if given) to the lockfile"""
+    with open(LOCKFILE, "w") as f:
+        f.write(f"{os.getpid()} {mode}" if mode else str(os.getpid()))
+
+
+def read_lockfile():
+    """Returns the lockfile's (PID, mode). The mode is None for the app"""
+    with open(LOCKFILE, "r") as f:
+        pid, _, mode = f.read().strip().partition(" ")
+
+    return int(pid), mode or None
+
+
+def has_lockfile():
+    """Whether another instance might be running. Doesn't check the PID"""
+    return os.path.isfile(LOCKFILE)
+
+
+def is_already_running(mode=None):
+    """Checks if another instance of the app is running
+
+    If it isn't, the lockfile is taken with our PID and ``mode``.
+    """
+    if not os.path.isfile(LOCKFILE):
+        write_pid(mode)
+        return False
+
+    # psutil takes a while to import, so only pay for it when there's a lockfile
+    import psutil
+
+    other_pid, _ = read_lockfile()
+
+    try:
+        proc = psutil.Process(other_pid)
+        return proc  # process exists and is running
+
+    except psutil.NoSuchProcess:
+        # process existed but is no longer running
+        # replace old pid with our new one
+        write_pid(mode)
+        return False
+
+
+def delete_lockfile():
+    """Deletes the lockfile if it exists"""
+    if os.path.isfile(LOCKFILE):
+        os.remove(LOCKFILE)
+        return True
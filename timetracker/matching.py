@@ -0,0 +1,257 @@
+"""MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Matching running processes to programs.
+#
+# Every program has one rule, picked by Program.match_type:
+#
+#   substring  the process name contains the pattern (the original behaviour,
+#              and what programs without a match_type use)
+#   exact      the process name is the pattern
+#   glob       the process name matches a shell-style pattern, like "python*.exe"
+#   regex      the process name matches a regular expression (re.search)
+#   exe        the process's executable path is the pattern
+#
+# Names and paths are compared case-insensitively. The pattern is
+# Program.match_pattern, falling back to the process name (or location for exe).
+
+import os
+import re
+import fnmatch
+import logging
+
+
+log = logging.getLogger("timetracker.matching")
+
+MATCH_TYPES = ("exact", "substring", "glob", "regex", "exe")
+
+# process names are matched case insensitively, like they always have been
+FLAGS = re.IGNORECASE | re.DOTALL
+
+# how many names a Matcher remembers the result for
+CACHE_SIZE = 4096
+
+
+class MatchRule:
+    """One program's rule. ``key`` is what a match returns (a program id, or a name)"""
+
+    __slots__ = ("key", "type", "pattern", "hits")
+
+    def __init__(self, key, type, pattern):
+        if type not in MATCH_TYPES:
+            raise ValueError(f"Unknown match type {type!r}")
+
+        self.key = key
+        self.type = type
+        self.pattern = pattern
+        self.hits = 0
+
+    def __repr__(self):
+        return f"<MatchRule(key={self.key!r}, type='{self.type}', pattern='{self.pattern}')>"
+
+    def regex(self):
+        """The rule as a regex that has to match the whole name (case insensitively)"""
+        pattern = self.pattern
+
+        if self.type == "substring":
+            return f".*{re.escape(pattern)}.*"
+        if self.type == "glob":
+            return fnmatch.translate(pattern)
+        if self.type == "regex":
+            return f".*(?:{pattern}).*"
+
+        raise ValueError(f"{self.type} rules aren't regexes")
+
+    def compile(self):
+        """Returns a function that checks a whole name against the rule
+
+        A regex rule that can't be wrapped by :meth:`regex` (say, one that starts
+        with inline flags like ``(?i)``) is searched for instead, which matches
+        the same names. Raises :class:`re.error` if the rule isn't valid.
+        """
+        try:
+            return re.compile(self.regex(), FLAGS).fullmatch
+        except re.error:
+            if self.type != "regex":
+                raise
+            return re.compile(self.pattern, FLAGS).search
+
+
+def rule_for_program(program):
+    """Builds a :class:`MatchRule` for a :class:`models.Program`, keyed by its id"""
+    type = program.match_type or "substring"
+
+    pattern = program.match_pattern
+    if not pattern:
+        pattern = program.location if type == "exe" else program.process_name
+
+    return MatchRule(program.id, type, pattern or "")
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.normpath(path)).lower()
+
+
+class Matcher:
+    """Every rule compiled into one matcher
+
+    Exact names and exe paths go in dicts. Every other rule is compiled
+    into a single regex alternation with a named group per rule, so a name is
+    checked against all of them in one pass. Build a new matcher whenever the
+    rules change (the :class:`registry.ProgramRegistry` does this on reload).
+
+    A process belongs to the first rule that matches it: exe paths first,
+    then exact names, then the other rules in order.
+
+    Each rule counts its hits, which makes rules that never match
+    (or match far too much) easy to spot with :meth:`stats`.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.keys = tuple(rule.key for rule in self.rules)
+
+        self.exact = {}  # lowercase name: rule
+        self.exe = {}  # normalized path: rule
+        self.patterns = []  # rules in the alternation
+
+        for rule in self.rules:
+            if not rule.pattern:
+                # an empty substring would match everything
+                log.warning(f"Ignoring {rule}: it has no pattern")
+            elif rule.type == "exact":
+                self.exact.setdefault(rule.pattern.lower(), rule)
+            elif rule.type == "exe":
+                self.exe.setdefault(normalize_path(rule.pattern), rule)
+            else:
+                self.patterns.append(rule)
+
+        self.combined = None
+        self.groups = {}  # group name: rule
+        self.separate = []  # (match function, rule) for rules that can't be combined
+
+        # lowercase name: rule or None. the same few names (svchost.exe,
+        # chrome.exe) make up most of a process table
+        self._cache = {}
+
+        self._compile()
+
+    @classmethod
+    def from_names(cls, process_names):
+        """A matcher of substring rules keyed by the names themselves, like the old matching"""
+        return cls(MatchRule(name, "substring", name) for name in process_names)
+
+    @property
+    def needs_exe(self):
+        """Whether :meth:`match` needs exe paths. Reading them isn't free"""
+        return bool(self.exe)
+
+    def _compile(self):
+        alternatives = []
+
+        for i, rule in enumerate(self.patterns):
+            try:
+                match = rule.compile()
+            except re.error as e:
+                log.warning(f"Ignoring {rule}: {e}")
+                continue
+
+            # a rule that has to be searched for can't be combined, and numbered
+            # backreferences would point at the wrong group once combined
+            if match.__name__ == "search" or (
+                rule.type == "regex" and re.search(r"\\[1-9]|\(\?P=", rule.pattern)
+            ):
+                self.separate.append((match, rule))
+                continue
+
+            group = f"r{i}"
+            self.groups[group] = rule
+            alternatives.append(f"(?P<{group}>{rule.regex()})")
+
+        if alternatives:
+            try:
+                self.combined = re.compile("|".join(alternatives), FLAGS)
+            except re.error:
+                # most likely a regex rule with its own named groups. fall back
+                log.warning("Couldn't combine the match rules, checking them one by one")
+                self.separate = [
+                    (rule.compile(), rule) for rule in self.groups.values()
+                ] + self.separate
+                self.groups = {}
+
+    def match(self, name, exe=None):
+        """Returns the key of the first rule that matches the process, or None"""
+        rule = self.match_rule(name, exe)
+        if rule is None:
+            return None
+
+        rule.hits += 1
+        return rule.key
+
+    def match_rule(self, name, exe=None):
+        if exe and self.exe:
+            rule = self.exe.get(normalize_path(exe))
+            if rule:
+                return rule
+
+        if not name:
+            return None
+
+        lowered = name.lower()
+        try:
+            return self._cache[lowered]
+        except KeyError:
+            pass
+
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+
+        rule = self._cache[lowered] = self._match_name(lowered)
+        return rule
+
+    def _match_name(self, name):
+        rule = self.exact.get(name)
+        if rule:
+            return rule
+
+        if self.combined:
+            found = self.combined.fullmatch(name)
+            if found:
+                return self.groups[found.lastgroup]
+
+        for match, rule in self.separate:
+            if match(name):
+                return rule
+
+        return None
+
+    def stats(self):
+        """Returns every rule with its hit count, most hits first"""
+        return sorted(
+            (
+                {"key": rule.key, "type": rule.type, "pattern": rule.pattern, "hits": rule.hits}
+                for rule in self.rules
+            ),
+            key=lambda stat: -stat["hits"],
+        )
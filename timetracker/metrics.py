@@ -0,0 +1,222 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import bisect
+import contextlib
+import logging
+import re
+import threading
+import time
+
+
+log = logging.getLogger("timetracker.metrics")
+sql_log = logging.getLogger("timetracker.sql")
+
+# upper bounds of the histogram buckets, in seconds (10 us to 10 s)
+BUCKETS = tuple(base * 10 ** exp for exp in range(-5, 1) for base in (1, 2, 5)) + (10.0,)
+
+TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+[\"']?(\w+)", re.IGNORECASE)
+
+# statement -> metric name, see statement_name
+statement_names = {}
+
+
+class Histogram:
+    """Counts how many observations fell into each latency bucket
+
+    Only the counts are kept, so it's the same size no matter how many
+    observations there are. Percentiles are estimated from the bucket bounds.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket the given percentile falls in"""
+        if not self.count:
+            return None
+
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class MetricsRegistry:
+    """Counters and latency histograms for the hot paths
+
+    Everything is cheap enough to leave on all the time: an observation is
+    a lock, a bisect and a few additions. Use :meth:`snapshot` to read the
+    numbers and :meth:`dump` to write them to the log.
+    """
+
+    def __init__(self, slow_query_threshold=0.1):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+
+        # statements slower than this (in seconds) are logged
+        self.slow_query_threshold = slow_query_threshold
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Times the body of a with statement into the named histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        """Returns a copy of every counter and histogram as plain dicts"""
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started_at,
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: histogram.to_dict() for name, histogram in self.histograms.items()
+                },
+            }
+
+    def dump(self, logger=log):
+        """Writes a snapshot to the log (and so to timetracker.log)"""
+        snapshot = self.snapshot()
+        logger.info(f"Metrics after {snapshot['uptime']:.0f} seconds:")
+
+        for name, value in sorted(snapshot["counters"].items()):
+            logger.info(f"  {name}: {value}")
+
+        for name, stats in sorted(snapshot["histograms"].items()):
+            logger.info(
+                f"  {name}: count={stats['count']} total={stats['total']:.3f}s "
+                f"mean={ms(stats['mean'])} p50={ms(stats['p50'])} "
+                f"p95={ms(stats['p95'])} p99={ms(stats['p99'])} max={ms(stats['max'])}"
+            )
+
+
+def ms(seconds):
+    """Formats seconds as milliseconds for the log"""
+    return f"{seconds * 1000:.3f}ms"
+
+
+def statement_name(statement):
+    """Turns a SQL statement into a short metric name like 'sql.select.time_entrys'
+
+    SQLAlchemy reuses the same statement strings, so the names are cached.
+    """
+    name = statement_names.get(statement)
+    if name is None:
+        verb = statement.split(None, 1)[0].lower() if statement.strip() else "unknown"
+        table = TABLE_PATTERN.search(statement)
+        name = f"sql.{verb}.{table.group(1)}" if table else f"sql.{verb}"
+
+        if len(statement_names) < 1024:
+            statement_names[statement] = name
+
+    return name
+
+
+def instrument_engine(engine, metrics=None):
+    """Times every statement run on the engine and logs the slow ones"""
+    import sqlalchemy
+
+    metrics = metrics or registry
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        metrics.observe(statement_name(statement), elapsed)
+
+        if elapsed > metrics.slow_query_threshold:
+            metrics.increment("sql.slow_queries")
+            sql_log.warning(
+                f"Slow query ({ms(elapsed)}): {' '.join(statement.split())[:500]} "
+                f"params={str(parameters)[:200]}"
+            )
+
+    def handle_error(context):
+        # after_cursor_execute doesn't run for failed statements
+        starts = context.connection.info.get("query_start") if context.connection else None
+        if starts:
+            starts.pop()
+        metrics.increment("sql.errors")
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    sqlalchemy.event.listen(engine, "handle_error", handle_error)
+
+
+# the registry the app records into
+registry = MetricsRegistry()
@@ -0,0 +1,163 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+
+import sqlalchemy
+
+import totals
+
+
+log = logging.getLogger("timetracker.migrations")
+
+
+# The schema version lives in SQLite's user_version pragma.
+# Migrations run in order, and each one bumps the version by one.
+# Never edit or reorder a migration that has shipped, add a new one instead.
+
+
+def add_time_entry_indexes(conn):
+    """Indexes for the queries the app runs all the time"""
+    # today's entries (MainDisplay.get_todays_time_entries)
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS ix_time_entrys_start_datetime "
+        "ON time_entrys (start_datetime)"
+    ))
+    # a single program's entries in a time range
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS ix_time_entrys_program_start "
+        "ON time_entrys (program_id, start_datetime)"
+    ))
+    # open entries (TimeEntry.stop_logging, TimeEntry.delete_unfinished_entries).
+    # there's only ever a handful of these, so a partial index stays tiny
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS ix_time_entrys_open "
+        "ON time_entrys (program_id) WHERE end_datetime IS NULL"
+    ))
+
+
+def add_daily_totals(conn):
+    """Per-day, per-program totals, backfilled from the existing entries"""
+    conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS daily_totals ("
+        "day DATE NOT NULL, "
+        "program_id INTEGER NOT NULL REFERENCES programs (id), "
+        "seconds FLOAT, "
+        "PRIMARY KEY (day, program_id))"
+    ))
+    totals.rebuild(conn)
+
+
+def add_last_seen(conn):
+    """Heartbeat column so unfinished entries can be recovered after a crash"""
+    # create_all already adds it to new databases
+    if not has_column(conn, "time_entrys", "last_seen"):
+        conn.execute(sqlalchemy.text("ALTER TABLE time_entrys ADD COLUMN last_seen DATETIME"))
+
+
+def add_match_rules(conn):
+    """Match rule columns. Existing programs keep substring matching (NULL)"""
+    for column in ("match_type", "match_pattern"):
+        if not has_column(conn, "programs", column):
+            conn.execute(sqlalchemy.text(f"ALTER TABLE programs ADD COLUMN {column} VARCHAR"))
+
+
+def add_window_titles(conn):
+    """Window title capture. create_all makes the window_titles table itself"""
+    if not has_column(conn, "time_entrys", "window_title_id"):
+        conn.execute(sqlalchemy.text(
+            "ALTER TABLE time_entrys ADD COLUMN window_title_id INTEGER REFERENCES window_titles (id)"
+        ))
+
+    if not has_column(conn, "programs", "capture_titles"):
+        conn.execute(sqlalchemy.text("ALTER TABLE programs ADD COLUMN capture_titles BOOLEAN"))
+
+
+def add_settings(conn):
+    """Key/value settings that belong to the db itself (like timestamps.format)"""
+    conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS settings (key VARCHAR PRIMARY KEY, value VARCHAR)"
+    ))
+
+
+def add_window_title_index(conn):
+    """Lets the retention job find window titles no entry uses without scanning every entry"""
+    conn.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS ix_time_entrys_window_title "
+        "ON time_entrys (window_title_id) WHERE window_title_id IS NOT NULL"
+    ))
+
+
+MIGRATIONS = [
+    add_time_entry_indexes,  # 1
+    add_daily_totals,  # 2
+    add_last_seen,  # 3
+    add_match_rules,  # 4
+    add_window_titles,  # 5
+    add_settings,  # 6
+    add_window_title_index,  # 7
+]
+
+
+def has_column(conn, table, column):
+    """Returns whether or not a table has a column"""
+    rows = conn.execute(sqlalchemy.text(f"PRAGMA table_info({table})")).fetchall()
+    return any(row[1] == column for row in rows)
+
+
+def get_version(conn):
+    """Returns the schema version of the database"""
+    return conn.execute(sqlalchemy.text("PRAGMA user_version")).scalar()
+
+
+def upgrade(engine):
+    """Runs every migration the database hasn't had yet
+
+    Returns the new schema version.
+    """
+    with engine.begin() as conn:
+        version = get_version(conn)
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            log.info(f"Migrating database to version {number} ({migration.__name__})...")
+            migration(conn)
+            conn.execute(sqlalchemy.text(f"PRAGMA user_version = {number}"))
+
+    return max(version, len(MIGRATIONS))
+
+
+def set_pragmas(dbapi_connection, connection_record):
+    """Tunes every new SQLite connection
+
+    WAL lets readers carry on while we write, and with WAL, synchronous=NORMAL
+    only fsyncs at checkpoints instead of on every commit. The cache is 16 MiB.
+    auto_vacuum only takes effect on a new db (before any table is created),
+    and lets the retention job give deleted pages back a few at a time.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-16384")
+    cursor.close()
@@ -24,26 +24,40 @@ SOFTWARE.
 
 import datetime
 import os.path
+import time
+import logging
 
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Date, Float, Boolean, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session
 
+import migrations
+import metrics
+import totals
+import timestamps
+from timestamps import Timestamp
 
-# need this or program will crash since sqlalchemy
-# doesn't create the folder for me (only the file)
-if not os.path.isdir("data"):
-    os.mkdir("data")
 
+log = logging.getLogger("timetracker.models")
 
-# Using an SQLite db for logging times
-engine = sqlalchemy.create_engine("sqlite:///data/timedata.db")
+
+# Using an SQLite db for logging times. Created by init_db
+engine = None
 Base = declarative_base()
 
 
 class Program(Base):
-    """Represents a program that timetracker will track"""
+    """Represents a program that timetracker will track
+
+    ``match_type`` is one of :data:`matching.MATCH_TYPES`. Programs added
+    before match rules existed have it set to NULL, which means substring
+    matching on ``process_name``. ``match_pattern`` overrides what the rule
+    matches against (``process_name``, or ``location`` for exe rules).
+
+    With ``capture_titles``, the foreground window's title is stored with
+    each of the program's entries (see :class:`WindowTitle`).
+    """
 
     __tablename__ = "programs"
 
@@ -55,21 +69,52 @@ class Program(Base):
         "TimeEntry", order_by="desc(TimeEntry.start_datetime)", lazy="dynamic"
     )
     added_at = Column(DateTime, default=datetime.datetime.utcnow)
+    match_type = Column(String)
+    match_pattern = Column(String)
+    capture_titles = Column(Boolean, default=False)
 
     def __repr__(self):
         return f"<Program(name='{self.name}', process_name='{self.process_name}')>"
 
 
+class WindowTitle(Base):
+    """A window title, stored once no matter how many entries have it
+
+    Titles are added through :class:`titles.TitleInterner`.
+    """
+
+    __tablename__ = "window_titles"
+
+    id = Column(Integer, primary_key=True)
+    title = Column(String, unique=True, nullable=False)
+
+    def __repr__(self):
+        return f"<WindowTitle(title='{self.title}')>"
+
+
 class TimeEntry(Base):
-    """Represents an entry of time for a program"""
+    """Represents an entry of time for a program
+
+    For programs that capture titles, a new entry is started whenever the
+    title changes, so each entry has a single (optional) window title.
+
+    The timestamps are naive UTC datetimes. How they're stored depends on the
+    db's format (see :mod:`timestamps`), which this class doesn't need to know.
+
+    Indexes on this table are created by :mod:`migrations`.
+    """
 
     __tablename__ = "time_entrys"
 
     id = Column(Integer, primary_key=True)
     program_id = Column(Integer, ForeignKey("programs.id"))
     program = relationship(Program, primaryjoin=program_id == Program.id)
-    start_datetime = Column(DateTime)
-    end_datetime = Column(DateTime)
+    start_datetime = Column(Timestamp)
+    end_datetime = Column(Timestamp)
+    # checkpointed while the entry is running, see EntryJournal.heartbeat
+    last_seen = Column(Timestamp)
+    window_title_id = Column(Integer, ForeignKey("window_titles.id"))
+    window_title = relationship(WindowTitle)
 
     def __repr__(self):
         return f"<TimeEntry(program_id='{self.program_id}', start_datetime='{self.start_datetime}', end_datetime='{self.end_datetime}')>"
@@ -93,6 +138,7 @@ class TimeEntry(Base):
             .first()
         )
         entry.end_datetime = datetime.datetime.utcnow()
+        DailyTotal.add_entry(session, entry)
         session.commit()
 
     @staticmethod
@@ -109,7 +155,362 @@ class TimeEntry(Base):
 
         session.commit()
 
+    @staticmethod
+    def close_unfinished_entries():
+        """Closes unfinished entries at their last heartbeat
+
+        These are left behind when the app doesn't shut down cleanly.
+        Entries that never got a heartbeat are deleted, since we don't
+        know how long they ran for. Returns the number of entries closed.
+        """
+        entries = session.query(TimeEntry).filter_by(end_datetime=None).all()
+        closed = 0
+
+        for entry in entries:
+            if entry.last_seen and entry.last_seen > entry.start_datetime:
+                entry.end_datetime = entry.last_seen
+                DailyTotal.add_entry(session, entry)
+                closed += 1
+            else:
+                session.delete(entry)
+
+        session.commit()
+        return closed
+
+
+class DailyTotal(Base):
+    """Total time tracked for a program on a (local) day
+
+    This is kept up to date whenever an entry is stopped, in the same
+    transaction that commits the stop (see :meth:`EntryJournal.flush`), so a
+    day's totals never need the entries themselves.
+    """
+
+    __tablename__ = "daily_totals"
+
+    day = Column(Date, primary_key=True)
+    program_id = Column(Integer, ForeignKey("programs.id"), primary_key=True)
+    seconds = Column(Float, default=0.0)
+
+    def __repr__(self):
+        return f"<DailyTotal(day='{self.day}', program_id='{self.program_id}', seconds='{self.seconds}')>"
+
+    @staticmethod
+    def add_entry(session, entry):
+        """Adds a finished entry's time to the totals for the day(s) it ran on"""
+        if entry.program_id is None:
+            return
+
+        for day, seconds in totals.split_by_day(entry.start_datetime, entry.end_datetime):
+            total = (
+                session.query(DailyTotal)
+                .filter_by(day=day, program_id=entry.program_id)
+                .first()
+            )
+
+            if total:
+                total.seconds += seconds
+            else:
+                session.add(DailyTotal(day=day, program_id=entry.program_id, seconds=seconds))
+
+    @staticmethod
+    def get_day(day):
+        """Returns a dict of program id to seconds tracked on a day"""
+        return {
+            t.program_id: t.seconds
+            for t in session.query(DailyTotal).filter_by(day=day)
+        }
+
+
+class EntryJournal:
+    """A write-behind buffer for time entry starts and stops
+
+    :meth:`TimeEntry.start_logging` and :meth:`TimeEntry.stop_logging` commit
+    (and fsync) once per focus switch. The journal keeps the changed entries
+    out of the session until ``max_events`` changes have built up, the oldest
+    change is ``max_age`` seconds old, or :meth:`flush` is called, and then
+    writes and commits them in one go. A crash loses at most ``max_events``
+    changes or ``max_age`` seconds of them, whichever comes first.
+
+    Nothing is written to the session between flushes, so the journal never
+    holds SQLite's write lock for longer than a flush takes, and other
+    connections (like the GUI's) can write in the meantime.
+
+A flush that fails because the db is locked keeps everything buffered and
+is tried again ``max_age`` seconds later, so a long write by another
+connection (like an import) only delays the entries.
+
+    Timestamps are taken when the event happens, not when it's flushed.
+
+    While an entry is running, :meth:`heartbeat_if_due` checkpoints its
+    ``last_seen`` time every ``heartbeat_interval`` seconds, so that after a
+    crash :meth:`TimeEntry.close_unfinished_entries` can close it instead of
+    throwing it away. Each heartbeat is a single UPDATE of one row, committed
+    together with anything else that's buffered. With WAL and synchronous=NORMAL
+    that is roughly one 4 KiB page appended to the WAL and no fsync, so the
+    default of 60 s costs about 60 commits and 240 KiB of writes per hour of
+    tracking. Nothing is written while no program is being tracked.
+    """
+
+    def __init__(self, session, max_events=50, max_age=30.0, heartbeat_interval=60.0, titles=None):
+        self.session = session
+        # a titles.TitleInterner for entries started with a window title
+        self.titles = titles
+        self.max_events = max_events
+        self.max_age = max_age
+        self.heartbeat_interval = heartbeat_interval
+        self.last_heartbeat = time.monotonic()
+
+        self.pending = 0
+        self.oldest = None  # time.monotonic() of the oldest unflushed change
+        # time.monotonic() of the last failed flush, until one succeeds
+        self.failed_at = None
+
+        # program_id: TimeEntry, so stopping doesn't need a query
+        self.open_entries = {}
+        # TimeEntry: window title (or None) of every entry changed since the last flush
+        self.changed = {}
+        # (local day, program_id): seconds of the stopped entries, added to
+        # daily_totals by flush. adding them on stop would need a query, which
+        # autoflushes and holds the write lock until the next flush
+        self.day_totals = {}
+        # program_id: end time, for stops of entries this journal didn't start
+        self.lost_stops = {}
+
+    def start(self, program_id, title=None):
+        """Same as :meth:`TimeEntry.start_logging`, but buffered
+
+        Returns the new entry.
+        """
+        now = datetime.datetime.utcnow()
+        entry = TimeEntry(program_id=program_id, start_datetime=now, last_seen=now)
+
+        # the title is only interned by flush, since that can insert a row
+        self.changed[entry] = title
+        self.open_entries[program_id] = entry
+        self._record()
+        return entry
+
+    def stop(self, program_id):
+        """Same as :meth:`TimeEntry.stop_logging`, but buffered
+
+        Returns the finished entry.
+        """
+        now = datetime.datetime.utcnow()
+        entry = self.open_entries.pop(program_id, None)
+
+        if entry is None:
+            # it was started before a rollback (or by something else). it's
+            # closed by flush, and an empty entry stands in for it until then
+            self.lost_stops[program_id] = now
+            self._record()
+            return TimeEntry(program_id=program_id, start_datetime=now, end_datetime=now)
+
+        entry.end_datetime = now
+        self.changed.setdefault(entry, None)
+        self._add_to_totals(entry.program_id, entry.start_datetime, now)
+        self._record()
+        return entry
+
+    def flush_if_due(self):
+        """Flushes if the oldest buffered change is older than max_age"""
+        if self.oldest is not None and time.monotonic() - self.oldest >= self.max_age:
+            self.flush()
+
+    def heartbeat_if_due(self):
+        """Runs :meth:`heartbeat` if it's been heartbeat_interval seconds since the last one"""
+        if time.monotonic() - self.last_heartbeat >= self.heartbeat_interval:
+            self.heartbeat()
+
+    def seconds_until_due(self):
+        """Returns the seconds until :meth:`flush_if_due` or :meth:`heartbeat_if_due` has work
+
+        Returns None if neither will until something else changes
+        (nothing is buffered and no entry is running).
+        """
+        deadlines = []
+        if self.oldest is not None:
+            deadlines.append(self.oldest + self.max_age)
+        if self.open_entries:
+            deadlines.append(self.last_heartbeat + self.heartbeat_interval)
+
+        if not deadlines:
+            return None
+
+        return max(min(deadlines) - time.monotonic(), 0.0)
+
+    def heartbeat(self):
+        """Checkpoints the running entries' last_seen time and flushes"""
+        self.last_heartbeat = time.monotonic()
+
+        if not self.open_entries:
+            return
+
+        now = datetime.datetime.utcnow()
+        for entry in self.open_entries.values():
+            entry.last_seen = now
+            self.changed.setdefault(entry, None)
+
+        self._record()
+        self.flush()
+
+    def flush(self):
+        """Commits every buffered change in one transaction
+
+        Returns the number of changes written. If the db is locked (or any other
+        :class:`sqlalchemy.exc.OperationalError`), only the session is rolled back.
+        Everything stays buffered, the error is raised, and the next
+        :meth:`flush_if_due` tries again. Any other error throws the buffer away.
+        """
+        if not self.pending:
+            return 0
+
+        # the entries are never added to the session. they're written with plain
+        # INSERTs and UPDATEs, so a rolled back flush can't leave them expired or
+        # half persisted, and the next one can simply write them again
+        table = TimeEntry.__table__
+        inserted = []
+        day_totals = dict(self.day_totals)
+
+        try:
+            with metrics.registry.timer("journal.flush"):
+                for entry, title in self.changed.items():
+                    values = {
+                        "program_id": entry.program_id,
+                        "start_datetime": entry.start_datetime,
+                        "end_datetime": entry.end_datetime,
+                        "last_seen": entry.last_seen,
+                    }
+                    if title and self.titles:
+                        values["window_title_id"] = self.titles.get_id(title)
+
+                    if entry.id is None:
+                        result = self.session.execute(table.insert().values(values))
+                        entry.id = result.inserted_primary_key[0]
+                        inserted.append(entry)
+                    else:
+                        self.session.execute(table.update().where(table.c.id == entry.id).values(values))
+
+                self._close_lost_entries(day_totals)
+                totals.add(self.session, day_totals)
+                self.session.commit()
+
+        except sqlalchemy.exc.OperationalError:
+            self.session.rollback()
+            for entry in inserted:
+                entry.id = None
+            # any titles it inserted were rolled back too
+            if self.titles:
+                self.titles.clear()
+
+            # wait another max_age before trying again
+            self.oldest = self.failed_at = time.monotonic()
+            metrics.registry.increment("journal.flush_errors")
+            log.warning(f"Couldn't flush {self.pending} time entry changes, keeping them to retry")
+            raise
+
+        except BaseException:
+            self.rollback()
+            raise
+
+        self.changed = {}
+        self.day_totals = {}
+        self.lost_stops = {}
+
+        metrics.registry.increment("journal.flushed_changes", self.pending)
+        flushed = self.pending
+        self.pending = 0
+        self.oldest = None
+        self.failed_at = None
+        log.debug(f"Flushed {flushed} time entry changes")
+        return flushed
+
+    def rollback(self):
+        """Rolls back the session, throwing away every buffered change"""
+        self.session.rollback()
+
+        if self.pending:
+            log.warning(f"Discarded {self.pending} buffered time entry changes")
+
+        self.pending = 0
+        self.oldest = None
+        self.failed_at = None
+        self.open_entries.clear()
+        self.changed = {}
+        self.day_totals = {}
+        self.lost_stops = {}
+
+        # any titles it inserted were rolled back too
+        if self.titles:
+            self.titles.clear()
+
+    def _add_to_totals(self, program_id, start, end, day_totals=None):
+        if program_id is None:
+            return
+
+        day_totals = self.day_totals if day_totals is None else day_totals
+        for day, seconds in totals.split_by_day(start, end):
+            key = (day, program_id)
+            day_totals[key] = day_totals.get(key, 0.0) + seconds
+
+    def _close_lost_entries(self, day_totals):
+        table = TimeEntry.__table__
+
+        for program_id, end in self.lost_stops.items():
+            # entries started after the stop are this journal's own
+            entries = self.session.execute(
+                sqlalchemy.select(table.c.id, table.c.start_datetime).where(
+                    table.c.program_id == program_id,
+                    table.c.end_datetime.is_(None),
+                    table.c.start_datetime <= end,
+                )
+            ).all()
+
+            for id, start in entries:
+                self.session.execute(table.update().where(table.c.id == id).values(end_datetime=end))
+                self._add_to_totals(program_id, start, end, day_totals)
+
+    def _record(self):
+        self.pending += 1
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+        # after a failed flush, wait for flush_if_due rather than retrying on every event
+        if self.pending >= self.max_events and self.failed_at is None:
+            self.flush()
+
+
+# bound to the engine by init_db
+Session = sessionmaker()
+
+# the session for whichever thread uses it (normally the GUI's).
+# it's only created on first use, so it picks up init_db's engine
+session = scoped_session(Session)
+
+
+def init_db(path="data/timedata.db"):
+    """Creates the engine, brings the schema up to date and binds the sessions
+
+    Nothing touches the db until this is called, so importing this module is
+    cheap. Calling it again just returns the existing engine.
+    """
+    global engine
+
+    if engine is not None:
+        return engine
+
+    # need this or program will crash since sqlalchemy
+    # doesn't create the folder for me (only the file)
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.mkdir(folder)
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    sqlalchemy.event.listen(engine, "connect", migrations.set_pragmas)
+    metrics.instrument_engine(engine)
 
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+    Base.metadata.create_all(engine)
+    migrations.upgrade(engine)
+    timestamps.load(engine)
+    Session.configure(bind=engine)
+    return engine
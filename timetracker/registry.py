@@ -0,0 +1,99 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import threading
+import logging
+
+import matching
+
+
+log = logging.getLogger("timetracker.registry")
+
+
+class ProgramRegistry:
+    """The tracked programs, loaded once and kept in memory
+
+    The activity loop used to query every program on every tick. The registry
+    instead loads them once, builds the lookups the loop needs, and only loads
+    them again after :meth:`invalidate` is called (which the add/remove program
+    displays do) or :meth:`reload` is called directly.
+
+    ``load`` should return a list of :class:`models.Program` that are safe to
+    read from any thread (detached from their session).
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._lock = threading.Lock()
+        self._stale = True
+
+        # bumped on every reload so callers can cheaply tell if anything changed
+        self.version = 0
+
+        self.programs = []
+        self.by_id = {}  # id: Program
+        self.matcher = matching.Matcher([])  # keyed by program id
+
+    def invalidate(self):
+        """Marks the programs as out of date. They're reloaded the next time they're needed"""
+        self._stale = True
+
+    def reload(self):
+        """Loads the programs from the db and rebuilds the lookups"""
+        # cleared before loading, so an invalidate() that comes in during the
+        # load marks the result stale again instead of being lost
+        with self._lock:
+            self._stale = False
+
+        try:
+            programs = self._load()
+        except BaseException:
+            self._stale = True
+            raise
+
+        with self._lock:
+            self.programs = programs
+            self.by_id = {p.id: p for p in programs}
+            self.matcher = matching.Matcher(matching.rule_for_program(p) for p in programs)
+            self.version += 1
+
+        log.info(f"Loaded {len(programs)} programs")
+
+    def get_programs(self):
+        """Returns the list of programs, reloading first if needed"""
+        if self._stale:
+            self.reload()
+
+        return self.programs
+
+    def get_matcher(self):
+        """Returns the :class:`matching.Matcher` for the programs, reloading first if needed
+
+        The matcher is only rebuilt on reload, so it's the same object until
+        the programs change.
+        """
+        if self._stale:
+            self.reload()
+
+        return self.matcher
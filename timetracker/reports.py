@@ -0,0 +1,175 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import csv
+import datetime
+import sys
+import logging
+
+import sqlalchemy
+
+
+log = logging.getLogger("timetracker.reports")
+
+GROUPINGS = ("program", "day", "week", "month")
+
+
+# SQL for each grouping's key, on a daily_totals row (d) joined to its program (p).
+# weeks are keyed by a plain number so SQLite doesn't format a label for every row;
+# julianday() + 0.5 is a whole number that's a multiple of 7 on Mondays
+LABELS = {
+    "program": "COALESCE(p.name, 'Deleted program ' || d.program_id)",
+    "day": "d.day",
+    "week": "CAST((julianday(d.day) + 0.5) / 7 AS INTEGER)",
+    "month": "substr(d.day, 1, 7)",
+}
+
+# julianday() + 0.5 of 0001-01-01, which is date.fromordinal(1)
+JULIAN_DAY_OFFSET = 1721425
+
+
+def week_label(key):
+    """Returns the ISO week label of a week key made by the week SQL above"""
+    year, week, _ = datetime.date.fromordinal(key * 7 - JULIAN_DAY_OFFSET).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def aggregate(conn, start, end, group_by, program=None):
+    """Sums the daily totals between two dates (inclusive) by the given groupings
+
+    The filtering and grouping is done by SQLite. Returns a dict of key tuple to
+    seconds, where the key has one item per grouping in the same order as ``group_by``.
+    Reading daily_totals instead of time_entrys means a year of data is
+    a few thousand rows no matter how often the user switched focus.
+    """
+    for grouping in group_by:
+        if grouping not in LABELS:
+            raise ValueError(f"Unknown grouping '{grouping}'")
+
+    labels = ", ".join(LABELS[grouping] for grouping in group_by)
+    sql = (
+        f"SELECT {labels}, SUM(d.seconds) FROM daily_totals d "
+        "LEFT JOIN programs p ON p.id = d.program_id "
+        "WHERE d.day >= :start AND d.day <= :end"
+    )
+    params = {"start": start.isoformat(), "end": end.isoformat()}
+
+    if program:
+        sql += " AND p.name = :program"
+        params["program"] = program
+
+    sql += " GROUP BY " + ", ".join(str(i) for i in range(1, len(group_by) + 1))
+
+    totals = {}
+    for *key, seconds in conn.execute(sqlalchemy.text(sql), params):
+        # only the handful of grouped rows get their week labels worked out here
+        key = tuple(
+            week_label(value) if grouping == "week" else value
+            for grouping, value in zip(group_by, key)
+        )
+        totals[key] = seconds
+
+    return totals
+
+
+def format_seconds(seconds):
+    """Formats seconds as HH:MM:SS (hours can go past 24)"""
+    seconds = int(round(seconds))
+    return f"{seconds // 3600:02d}:{(seconds // 60) % 60:02d}:{seconds % 60:02d}"
+
+
+def report(conn, start, end, group_by=("program",), program=None):
+    """Builds a report as a sorted list of (key tuple, seconds)"""
+    totals = aggregate(conn, start, end, group_by, program)
+
+    # time-based groupings sort in time order, programs sort by most time
+    if group_by[0] == "program":
+        return sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+    return sorted(totals.items())
+
+
+def write_report(rows, group_by, output=sys.stdout, as_csv=False):
+    """Writes a report made by :func:`report`"""
+    if as_csv:
+        writer = csv.writer(output)
+        writer.writerow([*group_by, "seconds"])
+        for key, seconds in rows:
+            writer.writerow([*key, f"{seconds:.0f}"])
+        return
+
+    if not rows:
+        output.write("No time tracked in that range.\n")
+        return
+
+    widths = [
+        max(len(grouping), *(len(key[i]) for key, _ in rows))
+        for i, grouping in enumerate(group_by)
+    ]
+
+    header = "  ".join(g.capitalize().ljust(w) for g, w in zip(group_by, widths))
+    output.write(f"{header}  Time\n")
+
+    for key, seconds in rows:
+        line = "  ".join(k.ljust(w) for k, w in zip(key, widths))
+        output.write(f"{line}  {format_seconds(seconds)}\n")
+
+    total = sum(seconds for _, seconds in rows)
+    output.write(f"{'Total'.ljust(sum(widths) + 2 * (len(widths) - 1))}  {format_seconds(total)}\n")
+
+
+def add_arguments(parser):
+    """Adds the report subcommand's arguments to an argparse parser"""
+    today = datetime.date.today()
+
+    parser.add_argument(
+        "--from",
+        dest="start",
+        type=datetime.date.fromisoformat,
+        default=today - datetime.timedelta(days=6),
+        help="First day of the report (YYYY-MM-DD). Defaults to a week ago",
+    )
+    parser.add_argument(
+        "--to",
+        dest="end",
+        type=datetime.date.fromisoformat,
+        default=today,
+        help="Last day of the report (YYYY-MM-DD). Defaults to today",
+    )
+    parser.add_argument(
+        "--group-by",
+        nargs="+",
+        choices=GROUPINGS,
+        default=["program"],
+        help="What to total by. Give more than one to break it down further",
+    )
+    parser.add_argument("--program", help="Only include the program with this name")
+    parser.add_argument("--csv", action="store_true", help="Output CSV instead of a table")
+
+
+def run(args, engine):
+    """Runs the report subcommand"""
+    with engine.connect() as conn:
+        rows = report(conn, args.start, args.end, args.group_by, args.program)
+
+    write_report(rows, args.group_by, as_csv=args.csv)
@@ -0,0 +1,242 @@
+"""MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import datetime
+import time
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+
+import metrics
+import timestamps
+import totals
+
+
+log = logging.getLogger("timetracker.retention")
+
+
+class RetentionJob:
+    """Ages out raw time entries, keeping their daily totals
+
+    Finished entries that ended more than ``days`` days ago (counted in whole
+    local days) are deleted, ``batch_size`` at a time. Their time is already
+    rolled up into daily_totals, which is kept up to date as entries stop, so
+    reports and today's totals don't change. The first day that still has its
+    entries is saved (see :func:`totals.rolled_up_before`), so
+    :func:`totals.rebuild` keeps the totals of the days before it.
+
+    Window titles that no entry uses anymore are deleted next, the same way.
+    Whoever interns titles (the database worker's :class:`titles.TitleInterner`)
+    has to forget its ids before the job runs, or it could hand out an id this
+    deletes. A title it interns after that belongs to a new entry, so it stays.
+
+    Afterwards the freed pages are given back with ``PRAGMA incremental_vacuum``,
+    ``vacuum_pages`` at a time. That only works once the db's auto_vacuum is
+    INCREMENTAL, which new databases are created with (see
+    :func:`migrations.set_pragmas`). Older ones need one full :meth:`vacuum`.
+
+    It uses its own connections and short transactions, sleeping ``pause``
+    seconds between them, so it can run in the background next to the
+    database worker. If the worker is holding the write lock, the batch is
+    retried until it isn't.
+    """
+
+    def __init__(self, engine, days, batch_size=1000, vacuum_pages=256, pause=0.05, retry_for=120):
+        if days < 1:
+            raise ValueError("Entries have to be kept for at least a day")
+
+        self.engine = engine
+        self.days = days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        self.retry_for = retry_for
+
+        self.last_run = None  # the stats of the last run
+
+    def cutoff(self):
+        """Returns (first local day to keep, its midnight as a UTC datetime)"""
+        day = datetime.date.today() - datetime.timedelta(days=self.days)
+        midnight = datetime.datetime.combine(day, datetime.time())
+        utc = midnight.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return day, utc
+
+    def run(self):
+        """Deletes the old entries and vacuums. Returns a dict of stats"""
+        started = time.perf_counter()
+        day, cutoff = self.cutoff()
+
+        log.info(f"Applying retention, removing entries that ended before {day}...")
+
+        # moved forward before anything is deleted, so a rebuild never
+        # recalculates a day that's missing entries
+        self._retry(self._set_rolled_up_before, day)
+
+        deleted = 0
+        while True:
+            count = self._retry(self._delete_batch, cutoff)
+            deleted += count
+            metrics.registry.increment("retention.deleted", count)
+            if count < self.batch_size:
+                break
+
+            time.sleep(self.pause)
+
+        deleted_titles = self.delete_unused_titles() if deleted else 0
+        freed = self.incremental_vacuum() if deleted else 0
+
+        self.last_run = {
+            "ran_at": datetime.datetime.utcnow().isoformat() + "Z",
+            "kept_from": day.isoformat(),
+            "deleted": deleted,
+            "deleted_titles": deleted_titles,
+            "freed_pages": freed,
+            "seconds": time.perf_counter() - started,
+        }
+        log.info(f"Retention deleted {deleted} entries and freed {freed} pages")
+        return self.last_run
+
+    def delete_unused_titles(self):
+        """Deletes the window titles no entry uses, in batches. Returns how many"""
+        deleted = 0
+        after = 0
+
+        while True:
+            count, after = self._retry(self._delete_titles_batch, after)
+            deleted += count
+            if after is None:
+                break
+
+            time.sleep(self.pause)
+
+        if deleted:
+            log.info(f"Deleted {deleted} unused window titles")
+        return deleted
+
+    def incremental_vacuum(self):
+        """Gives free pages back to the filesystem, a few at a time. Returns how many"""
+        with self.engine.connect() as conn:
+            if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+                log.info("auto_vacuum isn't INCREMENTAL on this db, it needs one full vacuum first")
+                return 0
+
+        freed = 0
+        while True:
+            pages = self._retry(self._vacuum_step)
+            if not pages:
+                break
+
+            freed += pages
+            time.sleep(self.pause)
+
+        if freed:
+            # the file only shrinks once the WAL is checkpointed, and the WAL
+            # itself is now about as big as what was freed. if someone's
+            # writing this just gives up, and the next checkpoint does it
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        return freed
+
+    def vacuum(self):
+        """Switches the db to incremental auto_vacuum with a full VACUUM
+
+        This rewrites the whole file and locks everyone else out while it does,
+        so only run it while nothing else is using the db.
+        """
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+
+    def _set_rolled_up_before(self, day):
+        with self.engine.begin() as conn:
+            if day.isoformat() > (totals.rolled_up_before(conn) or ""):
+                timestamps.set_setting(conn, "rolled_up_before", day.isoformat())
+
+    def _delete_batch(self, cutoff):
+        with self.engine.begin() as conn:
+            return conn.execute(
+                sqlalchemy.text(
+                    "DELETE FROM time_entrys WHERE id IN ("
+                    "SELECT id FROM time_entrys "
+                    "WHERE end_datetime IS NOT NULL AND end_datetime < :cutoff "
+                    "LIMIT :limit)"
+                ),
+                {"cutoff": timestamps.to_db(cutoff), "limit": self.batch_size},
+            ).rowcount
+
+    def _delete_titles_batch(self, after):
+        """Checks the next batch_size titles after the id ``after``
+
+        Returns (titles deleted, the last id checked or None when there are no more).
+        """
+        with self.engine.begin() as conn:
+            ids = conn.execute(
+                sqlalchemy.text(
+                    "SELECT id FROM window_titles WHERE id > :after ORDER BY id LIMIT :limit"
+                ),
+                {"after": after, "limit": self.batch_size},
+            ).scalars().all()
+            if not ids:
+                return 0, None
+
+            # uses the partial index on time_entrys.window_title_id
+            count = conn.execute(
+                sqlalchemy.text(
+                    "DELETE FROM window_titles WHERE id > :after AND id <= :last AND NOT EXISTS "
+                    "(SELECT 1 FROM time_entrys WHERE window_title_id = window_titles.id)"
+                ),
+                {"after": after, "last": ids[-1]},
+            ).rowcount
+
+        return count, ids[-1] if len(ids) == self.batch_size else None
+
+    def _vacuum_step(self):
+        with self.engine.connect() as conn:
+            before = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            if not before:
+                return 0
+
+            # the pragma frees a page per step, and sqlite3's execute() only
+            # steps it once. executescript runs it to the end
+            conn.connection.dbapi_connection.executescript(
+                f"PRAGMA incremental_vacuum({self.vacuum_pages});"
+            )
+            return max(before - conn.exec_driver_sql("PRAGMA freelist_count").scalar(), 0)
+
+    def _retry(self, func, *args):
+        """Calls func until it doesn't fail because the db is locked, for up to retry_for seconds"""
+        deadline = time.monotonic() + self.retry_for
+
+        while True:
+            try:
+                return func(*args)
+            except sqlalchemy.exc.OperationalError as e:
+                if "locked" not in str(e) or time.monotonic() > deadline:
+                    raise
+
+                metrics.registry.increment("retention.lock_retries")
+                time.sleep(1)
+
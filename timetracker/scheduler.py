@@ -0,0 +1,67 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+
+
+log = logging.getLogger("timetracker.scheduler")
+
+
+class AdaptiveScheduler:
+    """Works out how long the activity loop should sleep between ticks
+
+    While the user is active the loop ticks every ``min_interval`` seconds.
+    Once they've been idle for longer than ``idle_threshold``, the interval is
+    multiplied by ``backoff`` on every tick, up to ``max_interval``. As soon as
+    input resumes it drops straight back to ``min_interval``.
+
+    Since resumed input is only noticed on the next tick, backing off adds up
+    to ``interval - min_interval`` seconds of detection latency. That's capped
+    at ``max_added_latency`` no matter what ``max_interval`` is.
+    """
+
+    def __init__(
+        self, idle_threshold, min_interval=0.5, max_interval=30.0, max_added_latency=5.0, backoff=2.0
+    ):
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError("Polling intervals must be positive with min <= max")
+
+        self.idle_threshold = idle_threshold
+        self.min_interval = min_interval
+        self.max_interval = min(max_interval, min_interval + max_added_latency)
+        self.backoff = backoff
+
+        self.interval = min_interval
+
+    def next_interval(self, idle_time):
+        """Returns how long to sleep, given the user's current idle time in seconds"""
+        if idle_time is None or idle_time <= self.idle_threshold:
+            if self.interval != self.min_interval:
+                log.debug("Input resumed, back to fast ticks")
+            self.interval = self.min_interval
+
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+        return self.interval
@@ -0,0 +1,368 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import itertools
+import random
+import time
+import logging
+
+import psutil
+
+import utils
+
+log = logging.getLogger("timetracker.sources")
+
+
+class ActivitySource:
+    """Everything the activity loop needs to know about the desktop
+
+    :meth:`Tracker.activity_loop` only talks to the OS through one of these,
+    so the tracking core can run against a real Windows desktop
+    (:class:`Win32ActivitySource`) or a simulated one (:class:`SyntheticActivitySource`).
+    """
+
+    name = None
+
+    # see window_snapshot
+    _window_snapshot = None
+
+    def get_idle_time(self):
+        """Returns the time in seconds since the user's last input"""
+        raise NotImplementedError
+
+    def get_processes(self, matcher):
+        """Returns a dict of matcher key to a running process that matches it
+
+        ``matcher`` is a :class:`matching.Matcher`, or a list of process names
+        to match by substring (which are then the keys).
+        """
+        raise NotImplementedError
+
+    def foreground_pid(self):
+        """Returns the pid that owns the foreground window"""
+        raise NotImplementedError
+
+    def lookup_pid(self, pid, matcher):
+        """Returns the matcher key the pid's process matches, or None"""
+        raise NotImplementedError
+
+    def foreground_title(self):
+        """Returns the foreground window's title (or an empty string)"""
+        raise NotImplementedError
+
+    def is_active_window(self, pid):
+        """Returns whether or not the foreground window belongs to the pid"""
+        return pid == self.foreground_pid()
+
+    def enumerate_windows(self):
+        """Returns every top-level window as a :class:`utils.Window`"""
+        raise NotImplementedError
+
+    def start_tick(self):
+        """Called at the start of every activity tick. Drops the last tick's window snapshot"""
+        self._window_snapshot = None
+
+    def window_snapshot(self, fresh=False):
+        """Returns this tick's :class:`utils.WindowSnapshot`, taking it the first time it's needed
+
+        With ``fresh``, a new snapshot is taken without replacing this tick's.
+        """
+        if fresh:
+            return utils.WindowSnapshot(self.enumerate_windows)
+
+        snapshot = self._window_snapshot
+        if snapshot is None:
+            snapshot = self._window_snapshot = utils.WindowSnapshot(self.enumerate_windows)
+
+        return snapshot
+
+    def top_level_windows(self, pid):
+        """Returns a list of all top-level windows for a given pid"""
+        return self.window_snapshot().hwnds(pid)
+
+    def window_minimized(self, pid):
+        """Returns whether none of the pid's windows are visible and restored"""
+        return self.window_snapshot().is_minimized(pid)
+
+    def visible_window_pids(self, fresh=False):
+        """Returns the set of pids that own a visible, titled top-level window"""
+        return self.window_snapshot(fresh).visible_pids()
+
+    def iter_process_info(self):
+        """Yields (pid, name, exe) for every running process"""
+        raise NotImplementedError
+
+
+class Win32ActivitySource(ActivitySource):
+    """The real thing. Uses pywin32 and psutil through :mod:`utils`"""
+
+    name = "win32"
+
+    def __init__(self, enumerate_windows=None):
+        if utils.win32api is None:
+            raise RuntimeError("The win32 activity source requires pywin32 (Windows only)")
+
+        self.process_index = utils.ProcessIndex()
+        self._enumerate_windows = enumerate_windows or utils.enum_windows
+
+    def get_idle_time(self):
+        return utils.get_idle_time()
+
+    def get_processes(self, matcher):
+        return self.process_index.get_processes(matcher)
+
+    def foreground_pid(self):
+        return utils.get_foreground_pid()
+
+    def lookup_pid(self, pid, matcher):
+        return self.process_index.lookup(pid, matcher)
+
+    def foreground_title(self):
+        return utils.get_foreground_title()
+
+    def enumerate_windows(self):
+        return self._enumerate_windows()
+
+    def iter_process_info(self):
+        return utils.iter_process_info()
+
+
+class SyntheticProcess:
+    """A fake process that has the parts of :class:`psutil.Process` we use"""
+
+    def __init__(self, pid, name, create_time, exe=None):
+        self.pid = pid
+        self._name = name
+        self._create_time = create_time
+        self._exe = exe or f"C:\\Program Files\\{name}"
+        self.alive = True
+
+    def __repr__(self):
+        return f"<SyntheticProcess(pid={self.pid}, name='{self._name}')>"
+
+    def name(self):
+        return self._name
+
+    def create_time(self):
+        return self._create_time
+
+    def exe(self):
+        return self._exe
+
+    def is_running(self):
+        return self.alive
+
+
+class SyntheticActivitySource(ActivitySource):
+    """A scriptable fake desktop for load testing the activity loop
+
+    Processes, windows, focus and idle time are all controlled by the caller,
+    either directly (:meth:`spawn`, :meth:`kill`, :meth:`focus`, :meth:`set_idle`),
+    by queueing up steps with :meth:`load_script` and calling :meth:`step` once per tick,
+    or by letting :meth:`random_step` churn things about.
+
+    Script steps are tuples of ``(action, *args)`` where action is the
+    name of one of the methods above, for example ``("focus", "chrome.exe")``.
+    """
+
+    name = "synthetic"
+
+    def __init__(self, process_count=0, process_names=None, seed=None):
+        self.random = random.Random(seed)
+        self.processes = {}  # pid: SyntheticProcess
+        self.windows = {}  # pid: list of hwnds
+        self.minimized = set()  # hwnds
+        self.titles = {}  # pid: window title, if it isn't the process name
+        self.focused_pid = None
+        self.idle_time = 0.0
+        self.script = []
+        self.process_index = utils.ProcessIndex(self.pids, self.process)
+
+        self._pids = itertools.count(1000, 4)  # windows pids are multiples of 4
+        self._hwnds = itertools.count(0x10000)
+
+        if process_count:
+            self.populate(process_count, process_names)
+
+    def populate(self, count, process_names=None):
+        """Spawns ``count`` processes, cycling through ``process_names`` if given"""
+        if process_names:
+            names = itertools.cycle(process_names)
+        else:
+            names = (f"process{i}.exe" for i in itertools.count())
+
+        for _ in range(count):
+            self.spawn(next(names))
+
+    def spawn(self, name, windows=1):
+        """Starts a fake process with some top-level windows"""
+        pid = next(self._pids)
+        proc = SyntheticProcess(pid, name, time.time())
+        self.processes[pid] = proc
+        self.windows[pid] = [next(self._hwnds) for _ in range(windows)]
+        return proc
+
+    def kill(self, pid):
+        """Kills a fake process (and takes focus away from it if it had it)"""
+        pid = self._resolve_pid(pid)
+        proc = self.processes.pop(pid, None)
+        self.minimized.difference_update(self.windows.pop(pid, []))
+        self.titles.pop(pid, None)
+
+        if proc:
+            proc.alive = False
+
+        if self.focused_pid == pid:
+            self.focused_pid = None
+
+    def minimize(self, pid):
+        """Minimizes a process's windows. Accepts a pid or a process name"""
+        self.minimized.update(self.windows.get(self._resolve_pid(pid), []))
+
+    def restore(self, pid):
+        """Restores a process's windows. Accepts a pid or a process name"""
+        self.minimized.difference_update(self.windows.get(self._resolve_pid(pid), []))
+
+    def focus(self, pid):
+        """Brings a process to the foreground. Accepts a pid or a process name"""
+        self.focused_pid = self._resolve_pid(pid)
+
+    def set_title(self, pid, title):
+        """Changes a process's window title. Accepts a pid or a process name"""
+        self.titles[self._resolve_pid(pid)] = title
+
+    def set_idle(self, seconds):
+        """Pretends the user hasn't touched anything for this many seconds"""
+        self.idle_time = float(seconds)
+
+    def load_script(self, steps):
+        """Queues up steps to be run by :meth:`step`"""
+        self.script.extend(steps)
+
+    def step(self):
+        """Runs the next scripted step. Returns False once the script is empty"""
+        if not self.script:
+            return False
+
+        action, *args = self.script.pop(0)
+        getattr(self, action)(*args)
+        return True
+
+    def random_step(self, churn=0.001, focus_change=0.05, idle_chance=0.01):
+        """Randomly spawns/kills processes, moves focus and goes idle
+
+        ``churn`` is the fraction of the process table replaced per call.
+        """
+        rng = self.random
+
+        pids = list(self.processes)
+
+        for pid in rng.sample(pids, int(len(pids) * churn)):
+            name = self.processes[pid].name()
+            self.kill(pid)
+            self.spawn(name)
+
+        if pids and rng.random() < focus_change:
+            self.focused_pid = rng.choice(pids)
+
+        if rng.random() < idle_chance:
+            self.idle_time = rng.uniform(0, 3600)
+        else:
+            self.idle_time = 0.0
+
+    def process_iter(self):
+        """Same as :func:`psutil.process_iter`, but for the fake process table"""
+        return iter(list(self.processes.values()))
+
+    def pids(self):
+        """Same as :func:`psutil.pids`, but for the fake process table"""
+        return list(self.processes)
+
+    def process(self, pid):
+        """Same as :class:`psutil.Process`, but for the fake process table"""
+        try:
+            return self.processes[pid]
+        except KeyError:
+            raise psutil.NoSuchProcess(pid)
+
+    def get_idle_time(self):
+        return self.idle_time
+
+    def get_processes(self, matcher):
+        return self.process_index.get_processes(matcher)
+
+    def foreground_pid(self):
+        return self.focused_pid
+
+    def lookup_pid(self, pid, matcher):
+        return self.process_index.lookup(pid, matcher)
+
+    def foreground_title(self):
+        if self.focused_pid not in self.processes:
+            return ""
+
+        return self._title(self.focused_pid)
+
+    def enumerate_windows(self):
+        return [
+            utils.Window(hwnd, pid, True, hwnd in self.minimized, self._title(pid))
+            for pid, hwnds in self.windows.items()
+            for hwnd in hwnds
+        ]
+
+    def iter_process_info(self):
+        for proc in list(self.processes.values()):
+            yield proc.pid, proc.name(), proc.exe()
+
+    def _title(self, pid):
+        return self.titles.get(pid) or self.processes[pid].name()
+
+    def _resolve_pid(self, pid_or_name):
+        if isinstance(pid_or_name, int) or pid_or_name is None:
+            return pid_or_name
+
+        name = pid_or_name.lower()
+        for proc in self.processes.values():
+            if proc.name().lower() == name:
+                return proc.pid
+
+        raise ValueError(f"No synthetic process named {pid_or_name}")
+
+
+SOURCES = {
+    Win32ActivitySource.name: Win32ActivitySource,
+    SyntheticActivitySource.name: SyntheticActivitySource,
+}
+
+
+def get_source(name, **kwargs):
+    """Creates an activity source by name. See :data:`SOURCES`"""
+    try:
+        cls = SOURCES[name]
+    except KeyError:
+        raise ValueError(f"Unknown activity source '{name}'")
+
+    log.info(f"Using {name} activity source")
+    return cls(**kwargs)
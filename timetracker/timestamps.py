@@ -0,0 +1,231 @@
+"""MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import datetime
+import logging
+
+import sqlalchemy
+from sqlalchemy.types import TypeDecorator, DateTime
+
+
+log = logging.getLogger("timetracker.timestamps")
+
+# How time_entrys stores its timestamps. "iso" is SQLAlchemy's usual text
+# ("2020-01-01 12:00:00.000000"). The epoch formats store integer seconds
+# or milliseconds since the epoch (UTC), which take 4-6 bytes instead of
+# 26 and compare as integers.
+FORMATS = {"iso": None, "epoch_s": datetime.timedelta(seconds=1), "epoch_ms": datetime.timedelta(milliseconds=1)}
+ISO_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+EPOCH = datetime.datetime(1970, 1, 1)
+BATCH_SIZE = 5000
+
+# time_entrys' timestamp columns
+COLUMNS = ("start_datetime", "end_datetime", "last_seen")
+
+# the format of the db that's open. set by load (which init_db calls)
+format = "iso"
+
+
+def encode(value, format):
+    """Converts a naive UTC datetime into what's stored for the format"""
+    if value is None:
+        return None
+
+    unit = FORMATS[format]
+    if unit is None:
+        return value.strftime(ISO_FORMAT)
+
+    return (value - EPOCH) // unit
+
+
+def decode(value, format):
+    """Converts a stored value back into a naive UTC datetime
+
+    Text is always parsed as ISO, whatever the format.
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+
+    return EPOCH + value * (FORMATS[format] or FORMATS["epoch_s"])
+
+
+def to_db(value):
+    """:func:`encode` for the open db"""
+    return encode(value, format)
+
+
+def from_db(value):
+    """:func:`decode` for the open db"""
+    return decode(value, format)
+
+
+def duration_sql(start, end):
+    """An SQL expression for the seconds between two timestamp columns of the open db
+
+    Lets durations be summed in SQL without parsing a datetime per row.
+    """
+    unit = FORMATS[format]
+    if unit is None:
+        return f"((julianday({end}) - julianday({start})) * 86400.0)"
+
+    return f"(({end} - {start}) * {unit.total_seconds()!r})"
+
+
+class Timestamp(TypeDecorator):
+    """A DateTime column stored in the open db's :data:`format`
+
+    The table still declares DATETIME, and SQLite is happy to keep integers
+    in it, so the schema is the same for every format. Values go through
+    :func:`to_db` and :func:`from_db` in both directions (including in
+    filters), so the ORM API is the same too.
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        return to_db
+
+    def result_processor(self, dialect, coltype):
+        return from_db
+
+    def literal_processor(self, dialect):
+        def process(value):
+            value = to_db(value)
+            return repr(value) if isinstance(value, str) else str(value)
+
+        return process
+
+
+def get_setting(conn, key, default=None):
+    value = conn.execute(
+        sqlalchemy.text("SELECT value FROM settings WHERE key = :key"), {"key": key}
+    ).scalar()
+    return default if value is None else value
+
+
+def set_setting(conn, key, value):
+    if value is None:
+        conn.execute(sqlalchemy.text("DELETE FROM settings WHERE key = :key"), {"key": key})
+    else:
+        conn.execute(
+            sqlalchemy.text("INSERT OR REPLACE INTO settings (key, value) VALUES (:key, :value)"),
+            {"key": key, "value": str(value)},
+        )
+
+
+def load(engine):
+    """Reads the db's format into :data:`format`, finishing an interrupted conversion first"""
+    global format
+
+    with engine.connect() as conn:
+        target = get_setting(conn, "timestamp_format_target")
+
+    if target:
+        log.info(f"Finishing an interrupted conversion to {target} timestamps...")
+        convert(engine, target)
+
+    with engine.connect() as conn:
+        format = get_setting(conn, "timestamp_format", "iso")
+
+    return format
+
+
+def convert(engine, target, batch_size=BATCH_SIZE):
+    """Rewrites every time entry's timestamps in another format
+
+    Each batch of ``batch_size`` rows is its own transaction, so other
+    connections are never locked out for long. Progress is saved with every
+    batch, and :func:`load` picks up where an interrupted conversion left off.
+    Nothing that reads entries should run until this is done.
+
+    Returns the number of entries converted.
+    """
+    global format
+
+    if target not in FORMATS:
+        raise ValueError(f"Unknown timestamp format {target!r}")
+
+    with engine.begin() as conn:
+        current = get_setting(conn, "timestamp_format", "iso")
+        pending = get_setting(conn, "timestamp_format_target")
+
+        if pending and pending != target:
+            raise RuntimeError(f"A conversion to {pending} hasn't finished, convert to that first")
+
+        if current == target:
+            return 0
+
+        last_id = int(get_setting(conn, "timestamp_converted_id", 0))
+        set_setting(conn, "timestamp_format_target", target)
+
+    log.info(f"Converting timestamps from {current} to {target}...")
+    columns = ", ".join(COLUMNS)
+    assignments = ", ".join(f"{column} = :{column}" for column in COLUMNS)
+    converted = 0
+
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                sqlalchemy.text(
+                    f"SELECT id, {columns} FROM time_entrys WHERE id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": batch_size},
+            ).fetchall()
+
+            if not rows:
+                break
+
+            conn.execute(
+                sqlalchemy.text(f"UPDATE time_entrys SET {assignments} WHERE id = :id"),
+                [
+                    {
+                        "id": row[0],
+                        **{
+                            column: encode(decode(value, current), target)
+                            for column, value in zip(COLUMNS, row[1:])
+                        },
+                    }
+                    for row in rows
+                ],
+            )
+
+            last_id = rows[-1][0]
+            converted += len(rows)
+            set_setting(conn, "timestamp_converted_id", last_id)
+
+        log.debug(f"Converted {converted} entries")
+
+    with engine.begin() as conn:
+        set_setting(conn, "timestamp_format", target)
+        set_setting(conn, "timestamp_format_target", None)
+        set_setting(conn, "timestamp_converted_id", None)
+
+    format = target
+    log.info(f"Converted {converted} entries to {target} timestamps")
+    return converted
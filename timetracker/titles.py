@@ -0,0 +1,115 @@
+"""MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import re
+import collections
+import logging
+
+import sqlalchemy
+
+
+log = logging.getLogger("timetracker.titles")
+
+
+class TitleRedactor:
+    """Cleans up window titles before they're stored
+
+    Every match of the ``patterns`` (regexes) is replaced with ``replacement``,
+    and what's left is cut down to ``max_length`` characters. Returns None for
+    titles that end up empty, so they aren't stored at all.
+    """
+
+    def __init__(self, patterns=(), replacement="[redacted]", max_length=200):
+        self.replacement = replacement
+        self.max_length = max_length
+        self.regex = None
+
+        compiled = []
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                log.warning(f"Ignoring title redaction {pattern!r}: {e}")
+            else:
+                compiled.append(f"(?:{pattern})")
+
+        if compiled:
+            self.regex = re.compile("|".join(compiled))
+
+    def __call__(self, title):
+        if not title:
+            return None
+
+        if self.regex:
+            title = self.regex.sub(self.replacement, title)
+
+        title = title.strip()[:self.max_length]
+        return title or None
+
+
+class TitleInterner:
+    """Maps window titles to rows in the window_titles table
+
+    Entries store a window_title_id instead of the title itself, so a title
+    that comes up again and again costs one integer per entry. The most
+    recently used ``max_size`` titles are kept in memory, so the common case
+    doesn't query the db at all.
+
+    It runs on the session of whoever owns it (the database worker). New titles
+    are inserted in that session's transaction, so :meth:`clear` has to be
+    called if it's rolled back.
+    """
+
+    def __init__(self, session, max_size=1024):
+        self.session = session
+        self.max_size = max_size
+        self.ids = collections.OrderedDict()  # title: id, least recently used first
+
+    def get_id(self, title):
+        """Returns the id for a title, inserting it if it's new"""
+        try:
+            self.ids.move_to_end(title)
+            return self.ids[title]
+        except KeyError:
+            pass
+
+        title_id = self.session.execute(
+            sqlalchemy.text("SELECT id FROM window_titles WHERE title = :title"), {"title": title}
+        ).scalar()
+
+        if title_id is None:
+            result = self.session.execute(
+                sqlalchemy.text("INSERT INTO window_titles (title) VALUES (:title)"), {"title": title}
+            )
+            title_id = result.lastrowid
+
+        self.ids[title] = title_id
+        if len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+        return title_id
+
+    def clear(self):
+        """Forgets every cached id"""
+        self.ids.clear()
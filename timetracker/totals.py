@@ -0,0 +1,144 @@
+"""
+MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import datetime
+import logging
+
+import sqlalchemy
+
+import timestamps
+
+
+log = logging.getLogger("timetracker.totals")
+
+
+# Helpers for the daily_totals rollup table (see models.DailyTotal).
+# These work on plain connections so migrations can use them too.
+
+
+def utc_to_local(dt):
+    """Converts a naive UTC datetime into a naive local one"""
+    return dt.replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def parse_datetime(value):
+    """Parses a time entry timestamp read with raw SQL, whatever format it's stored in"""
+    return timestamps.from_db(value)
+
+
+def split_by_day(start, end):
+    """Splits a UTC time range into (local date, seconds) pieces
+
+    An entry that runs past midnight counts towards both days.
+    """
+    start = utc_to_local(start)
+    end = utc_to_local(end)
+
+    while start.date() < end.date():
+        midnight = datetime.datetime.combine(start.date() + datetime.timedelta(days=1), datetime.time())
+        yield start.date(), (midnight - start).total_seconds()
+        start = midnight
+
+    if end > start:
+        yield start.date(), (end - start).total_seconds()
+
+
+def add(conn, increments):
+    """Adds {(day, program_id): seconds} to daily_totals with one upsert per row"""
+    if not increments:
+        return
+
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO daily_totals (day, program_id, seconds) VALUES (:day, :program_id, :seconds) "
+            "ON CONFLICT (day, program_id) DO UPDATE SET seconds = seconds + excluded.seconds"
+        ),
+        [
+            {"day": day.isoformat(), "program_id": program_id, "seconds": seconds}
+            for (day, program_id), seconds in increments.items()
+        ],
+    )
+
+
+def rolled_up_before(conn):
+    """Returns the first day (as an ISO string) that still has all its entries, or None
+
+    The entries of the days before it were deleted by :class:`retention.RetentionJob`,
+    so daily_totals is the only record of them.
+    """
+    has_settings = conn.execute(sqlalchemy.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'settings'"
+    )).scalar()
+
+    return timestamps.get_setting(conn, "rolled_up_before") if has_settings else None
+
+
+def rebuild(conn, batch_size=10000):
+    """Recalculates the daily_totals table from time_entrys
+
+    Days whose entries were removed by the retention job are left alone.
+    Entries are streamed, so this only keeps one number per day per program in memory.
+    Returns the number of rows written.
+    """
+    first_day = rolled_up_before(conn)
+
+    if first_day:
+        conn.execute(sqlalchemy.text("DELETE FROM daily_totals WHERE day >= :day"), {"day": first_day})
+        first_day = datetime.date.fromisoformat(first_day)
+    else:
+        conn.execute(sqlalchemy.text("DELETE FROM daily_totals"))
+
+    totals = {}  # (day, program_id): seconds
+    result = conn.execute(sqlalchemy.text(
+        "SELECT program_id, start_datetime, end_datetime FROM time_entrys "
+        "WHERE end_datetime IS NOT NULL AND program_id IS NOT NULL"
+    ))
+
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+
+        for program_id, start, end in rows:
+            for day, seconds in split_by_day(parse_datetime(start), parse_datetime(end)):
+                if first_day and day < first_day:
+                    continue
+
+                key = (day, program_id)
+                totals[key] = totals.get(key, 0.0) + seconds
+
+    if totals:
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO daily_totals (day, program_id, seconds) "
+                "VALUES (:day, :program_id, :seconds)"
+            ),
+            [
+                {"day": day.isoformat(), "program_id": program_id, "seconds": seconds}
+                for (day, program_id), seconds in totals.items()
+            ],
+        )
+
+    log.info(f"Rebuilt {len(totals)} daily totals")
+    return len(totals)
@@ -0,0 +1,613 @@
+"""MIT License
+
+Copyright (c) 2020 Fyssion
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import json
+import threading
+import queue
+import logging
+import time
+import datetime
+import functools
+import concurrent.futures
+
+import models
+from models import Session, Program, TimeEntry, DailyTotal
+from dbworker import DatabaseWorker
+from registry import ProgramRegistry
+from scheduler import AdaptiveScheduler
+from aggregator import TodayAggregator
+from control import ControlServer, load_token
+from catalog import ProcessCatalog
+from titles import TitleRedactor
+from retention import RetentionJob
+import utils
+import sources
+import metrics
+
+log = logging.getLogger("timetracker.tracker")
+
+
+class Tracker:
+    """The tracking engine: activity loop, db writes, control server and update checks
+
+    Nothing in here imports tkinter, so it can run as a plain background
+    process. The GUI (see app.py) attaches to a running tracker when it's
+    opened and is torn down again when it's closed.
+
+    Anything that has to happen on the main thread (like opening the GUI)
+    is posted with :meth:`post_to_queue`. :meth:`run` works through those
+    until :meth:`stop` is called, and the GUI does the same while it's open.
+    """
+
+    def __init__(self, source=None):
+        log.info("Initiating Tracker...")
+
+        # check if a data folder exists
+        if not os.path.exists("data"):
+            log.info("data dir not found, creating...")
+            os.mkdir("data")
+
+        # TODO: make more things that you can configure (theme for example)
+        default_config = {"mouse_timeout": 10}
+
+        # check if a data/config file exists
+        if not os.path.isfile("data/config.json"):
+            log.info("config file not found, creating...")
+            with open("data/config.json", "w") as f:
+                json.dump(default_config, f, indent=4, sort_keys=True)
+                self.config = default_config
+
+        else:
+            log.info("Opening config file...")
+            with open("data/config.json", "r") as f:
+                self.config = json.load(f)
+
+        metrics.registry.slow_query_threshold = self.config.get("slow_query_threshold", 0.1)
+
+        # where the activity loop gets processes, focus and idle time from
+        self.source = source or sources.get_source(self.config.get("activity_source", "win32"))
+
+        # lists running processes for the add program dialog
+        self.process_catalog = ProcessCatalog(
+            self.source, max_age=self.config.get("process_list_max_age", 60)
+        )
+
+        self.current_program = None
+        # the running entry's window title, for programs that capture titles
+        self.current_title = None
+
+        # window titles are cleaned up with this before they're stored
+        self.redact_title = TitleRedactor(
+            self.config.get("title_redactions", []),
+            max_length=self.config.get("title_max_length", 200),
+        )
+
+        # cache for resolve_foreground_program
+        self.foreground_pid = None
+        self.foreground_version = None
+        self.foreground_program = None
+
+        log.info("Closing unfinished time entries...")
+        closed = TimeEntry.close_unfinished_entries()
+        log.info(f"Closed {closed} unfinished time entries at their last heartbeat")
+
+        # all database calls from the tracking side go through this thread,
+        # which buffers time entry writes and commits them in groups
+        self.db = DatabaseWorker(
+            Session,
+            max_events=self.config.get("journal_max_events", 50),
+            max_age=self.config.get("journal_max_age", 30),
+            heartbeat_interval=self.config.get("heartbeat_interval", 60),
+            title_cache_size=self.config.get("title_cache_size", 1024),
+        )
+        self.db.start()
+
+        # the programs the activity loop tracks. only reloaded when invalidated
+        self.registry = ProgramRegistry(self.load_tracked_programs)
+
+        # objects with program_started(entry) and program_stopped(entry) methods
+        # that get told whenever logging starts or stops
+        self.listeners = []
+
+        # today's totals, kept in memory for the GUI and the control channel
+        self.today = TodayAggregator(DailyTotal.get_day)
+        self.add_listener(self.today)
+
+        # how often the activity loop ticks. backs off while the user is idle
+        self.scheduler = AdaptiveScheduler(
+            int(self.config["mouse_timeout"]),
+            min_interval=self.config.get("poll_min_interval", 0.5),
+            max_interval=self.config.get("poll_max_interval", 30),
+            max_added_latency=self.config.get("poll_max_added_latency", 5),
+        )
+        self.last_idle_time = None
+        # set to wake the activity loop up early
+        self.activity_wakeup = threading.Event()
+
+        # paused through the control channel. nothing is tracked until resumed
+        self.paused = False
+        self.started_at = time.time()
+
+        # the open GUI's Application, if there is one
+        self.gui = None
+        # set when a headless check finds an update, so the GUI can ask about it
+        self.update_available = False
+
+        # callables for the main thread, see post_to_queue
+        self.request_queue = queue.Queue()
+        self.stopping = False
+
+        log.info("Starting activity loop...")
+
+        # create the activity loop thread and start it
+        self.activity_thread = threading.Thread(target=self.activity_loop, name="timetracker-activity")
+        self.activity_thread.daemon = True  # close the thread when the tracker stops
+        self.activity_thread.start()
+
+        # start the control server, which other processes use to talk to this one
+        handlers = {
+            "status": self.get_status,
+            "current_program": self.get_current_program,
+            "today_totals": self.get_today_totals,
+            "pause": self.pause,
+            "resume": self.resume,
+            "flush": self.db.flush,
+            "open_gui": self.open_gui,
+            "stop": self.stop,
+            "metrics": metrics.registry.snapshot,
+            "dump_metrics": metrics.registry.dump,
+            "match_rules": self.get_match_rules,
+            "retention": self.get_retention,
+        }
+        try:
+            self.control_server = ControlServer(handlers, load_token(create=True))
+        except OSError:
+            log.exception("Failed to start the control server, continuing without it")
+            self.control_server = None
+        else:
+            self.control_server.start()
+
+        # create the updater loop that runs every 24 hours
+        callback = functools.partial(self.post_to_queue, self.check_for_updates)
+        self.updater_thread = threading.Thread(target=utils.loop, args=(86400, callback))
+        self.updater_thread.daemon = True  # close the thread when the tracker stops
+        self.updater_thread.start()
+
+        # deletes old entries (keeping their daily totals). off unless retention_days is set
+        self.retention = None
+        if self.config.get("retention_days"):
+            self.retention = RetentionJob(
+                models.engine,
+                int(self.config["retention_days"]),
+                batch_size=self.config.get("retention_batch_size", 1000),
+            )
+            self.retention_thread = threading.Thread(
+                target=utils.loop,
+                args=(self.config.get("retention_interval", 86400), self.apply_retention),
+                name="timetracker-retention",
+            )
+            self.retention_thread.daemon = True  # close the thread when the tracker stops
+            self.retention_thread.start()
+
+    def run(self):
+        """Runs callables posted to the main thread until :meth:`stop` is called"""
+        log.info("Tracker running")
+
+        while not self.stopping:
+            # blocks until there's something to do. stop() posts None to wake it up
+            self.run_request(self.request_queue.get())
+
+    def run_pending(self):
+        """Runs every callable that's been posted so far without waiting for more"""
+        while True:
+            try:
+                request = self.request_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            self.run_request(request)
+
+    def run_request(self, request):
+        if request is None:
+            return
+
+        future, callable, args, kwargs, submitted_at = request
+        if future.set_running_or_notify_cancel():
+            metrics.registry.observe("main_queue.wait", time.perf_counter() - submitted_at)
+            try:
+                future.set_result(callable(*args, **kwargs))
+            except Exception as e:
+                log.exception(f"Failed to run {callable} on the main thread")
+                future.set_exception(e)
+
+    def post_to_queue(self, callable, *args, **kwargs):
+        """Runs a callable on the main thread without waiting
+
+        Returns a :class:`concurrent.futures.Future` for the result.
+        """
+        future = concurrent.futures.Future()
+        self.request_queue.put((future, callable, args, kwargs, time.perf_counter()))
+        return future
+
+    def stop(self):
+        """Stops :meth:`run` (and closes the GUI if it's open)"""
+        log.info("Stopping tracker...")
+        self.stopping = True
+        self.request_queue.put(None)  # wake run() up
+
+    def stop_tracking(self):
+        """Stops the activity loop and ends the running entry now
+
+        Left open, the entry would only be closed at its last heartbeat on the
+        next start, or deleted if it never had one.
+        """
+        self.stopping = True
+        self.activity_wakeup.set()
+        self.activity_thread.join(10)
+
+        if self.current_program:
+            log.info(f"Stopping logging program {self.current_program}")
+            self.stop_logging_program(self.current_program)
+            self.current_program = None
+
+    def close(self):
+        """Shuts the control server and db worker down. Call after :meth:`run` returns"""
+        if self.control_server:
+            self.control_server.close()
+
+        self.stop_tracking()
+
+        log.info("Flushing buffered time entries...")
+        self.db.close()
+
+        metrics.registry.dump()
+
+    def open_gui(self):
+        """Opens the GUI from any thread. Doesn't wait for it to open"""
+        self.post_to_queue(self.show_gui)
+
+    def show_gui(self):
+        """Opens the GUI, or brings it to the front if it's already open
+
+        Has to run on the main thread. Returns once the GUI is closed,
+        but requests keep being run while it's open.
+        """
+        if self.gui:
+            self.gui.start_gui()
+            return
+
+        # the GUI (and tkinter) are only imported the first time they're needed
+        import app
+
+        app.run_gui(self)
+
+    def check_for_updates(self):
+        """Checks for updates. Runs on the main thread
+
+        The GUI asks the user about it. Without the GUI, it's just noted
+        and the GUI asks the next time it's opened.
+        """
+        if self.gui:
+            self.gui.perform_update()
+            return
+
+        import updater
+
+        log.info("Checking for updates (headless)...")
+        if updater.check_for_updates():
+            log.info("An update is available, it'll be offered next time the GUI opens")
+            self.update_available = True
+
+    def apply_retention(self):
+        """Runs the retention job. Called on its own thread, so it never holds up tracking"""
+        try:
+            # the job may delete titles the worker has cached ids for
+            self.db.submit(lambda session: self.db.journal.titles.clear()).result()
+            self.retention.run()
+        except Exception:
+            log.exception("Retention job failed")
+
+    def get_retention(self):
+        """The retention settings and the last run's stats. For the control channel"""
+        if not self.retention:
+            return {"enabled": False}
+
+        return {"enabled": True, "days": self.retention.days, "last_run": self.retention.last_run}
+
+    def load_tracked_programs(self):
+        """Loads the programs for the :class:`ProgramRegistry` on the database worker
+
+        The programs are detached from the worker's session so that
+        reading them from other threads never goes back to the db.
+        """
+
+        def load(session):
+            programs = session.query(Program).all()
+            for program in programs:
+                session.expunge(program)
+
+            return programs
+
+        return self.db.submit(load).result()
+
+    def add_listener(self, listener):
+        """Registers a listener for start/stop transitions"""
+        self.listeners.append(listener)
+
+    def start_logging_program(self, program, title=None):
+        """Start logging a program to the db, optionally with its window title
+
+        Returns a future for the new entry.
+        """
+        metrics.registry.increment("tracking.starts")
+        future = self.db.start_logging(program.id, title)
+        future.add_done_callback(functools.partial(self.notify_listeners, "program_started"))
+        return future
+
+    def stop_logging_program(self, program):
+        """Stop logging a program to the db
+
+        Returns a future for the finished entry.
+        """
+        metrics.registry.increment("tracking.stops")
+        future = self.db.stop_logging(program.id)
+        future.add_done_callback(functools.partial(self.notify_listeners, "program_stopped"))
+        return future
+
+    def notify_listeners(self, event, future):
+        """Passes a finished start/stop on to the listeners
+
+        This runs on the database worker thread.
+        """
+        try:
+            entry = future.result()
+        except Exception:
+            log.exception(f"Database worker failed on {event}")
+            return
+
+        for listener in self.listeners:
+            getattr(listener, event)(entry)
+
+    def pause(self):
+        """Stops tracking until :meth:`resume` is called"""
+        if not self.paused:
+            log.info("Tracking paused")
+            self.paused = True
+            self.activity_wakeup.set()
+
+        return {"paused": True}
+
+    def resume(self):
+        """Starts tracking again after :meth:`pause`"""
+        if self.paused:
+            log.info("Tracking resumed")
+            self.paused = False
+            self.activity_wakeup.set()
+
+        return {"paused": False}
+
+    def get_status(self):
+        """A summary of what the tracker is doing, for the control channel"""
+        return {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started_at,
+            "paused": self.paused,
+            "idle_time": self.last_idle_time,
+            "poll_interval": self.scheduler.interval,
+            "programs": len(self.registry.programs),
+            "current_program": self.get_current_program(),
+            "gui_open": self.gui is not None,
+            "update_available": self.update_available,
+        }
+
+    def get_current_program(self):
+        """The running entry's program, or None. For the control channel"""
+        _, current = self.today.snapshot()
+        if not current:
+            return None
+
+        program_id, start = current
+        program = self.registry.by_id.get(program_id)
+
+        return {
+            "id": program_id,
+            "name": program.name if program else None,
+            "process_name": program.process_name if program else None,
+            "started_at": start.isoformat() + "Z",
+            "seconds": (datetime.datetime.utcnow() - start).total_seconds(),
+            "title": self.current_title,
+        }
+
+    def get_today_totals(self):
+        """Today's seconds per program name, including the running entry. For the control channel"""
+        by_id = self.registry.by_id
+        return {
+            (by_id[program_id].name if program_id in by_id else str(program_id)): seconds
+            for program_id, seconds in self.today.live_totals().items()
+        }
+
+    def get_match_rules(self):
+        """Every program's match rule with its hit count. For the control channel"""
+        names = {program_id: program.name for program_id, program in self.registry.by_id.items()}
+        return [
+            dict(stat, program=names.get(stat["key"])) for stat in self.registry.matcher.stats()
+        ]
+
+    def capture_title(self, program):
+        """Returns the program's redacted window title, or None if it doesn't capture titles
+
+        Only the foreground window's title is read, and only for programs
+        that opted in, so this costs nothing for everything else.
+        """
+        if not program or not program.capture_titles:
+            return None
+
+        with metrics.registry.timer("tick.title"):
+            return self.redact_title(self.source.foreground_title())
+
+    def find_active_program(self, processes, programs):
+        """Checks every running tracked process to see if it's the active window
+
+        ``processes`` is keyed by program id, ``programs`` maps ids to programs.
+        """
+        for program_id, proc in processes.items():
+            if self.source.is_active_window(proc.pid):
+                return programs.get(program_id)
+
+        return None
+
+    def resolve_foreground_program(self, matcher, programs):
+        """Maps the foreground window's pid straight to a program
+
+        Only one process can own the foreground window, so we only need to
+        look at the process table when the foreground pid changes.
+        """
+        pid = self.source.foreground_pid()
+        version = self.registry.version
+
+        if pid == self.foreground_pid and version == self.foreground_version:
+            return self.foreground_program
+
+        program_id = self.source.lookup_pid(pid, matcher) if pid else None
+
+        self.foreground_pid = pid
+        self.foreground_version = version
+        self.foreground_program = programs.get(program_id)
+        return self.foreground_program
+
+    def activity_loop(self):
+        """Main activity loop that does all the program detection
+
+        This loop checks if any of the programs are open, if they are active, and
+        whether or not the mouse is active.
+
+        Since it is in run in another thread, all database calls must be
+        submitted to the database worker.
+        """
+        while not self.stopping:
+            with metrics.registry.timer("tick.total"):
+                self.activity_tick()
+
+            # while paused, sleep until resume() wakes us up
+            interval = None if self.paused else self.scheduler.next_interval(self.last_idle_time)
+            self.activity_wakeup.wait(interval)
+            self.activity_wakeup.clear()
+
+    def activity_tick(self):
+        """Runs a single pass of the activity loop"""
+        metrics.registry.increment("tick.count")
+
+        # anything that looks at windows during this tick shares one snapshot
+        self.source.start_tick()
+
+        if self.paused:
+            if self.current_program:
+                log.info(f"Tracking is paused, stopping logging program {self.current_program}")
+                self.stop_logging_program(self.current_program)
+                self.current_program = None
+
+            return
+
+        # check immediately if the user is inactive to save on processing time
+        with metrics.registry.timer("tick.idle_check"):
+            time_since = self.last_idle_time = self.source.get_idle_time()
+
+        if time_since > int(self.config["mouse_timeout"]):
+            metrics.registry.increment("tick.idle")
+
+            if self.current_program:
+                log.info(
+                    f"It's been {self.config['mouse_timeout']} second since last active, "
+                    f"stopping logging program {self.current_program}"
+                )
+                self.stop_logging_program(self.current_program)
+                self.current_program = None
+
+            # doing this here so we can return and not worry about indenting
+            return
+
+        # if the current program isn't set, check if one of the programs
+        # is an active window
+        matcher = self.registry.get_matcher()
+        programs = self.registry.by_id
+
+        if self.config.get("resolution_mode", "foreground") == "scan":
+            with metrics.registry.timer("tick.process_scan"):
+                processes = self.source.get_processes(matcher)
+            if not processes:
+                return
+
+            with metrics.registry.timer("tick.foreground_check"):
+                active_program = self.find_active_program(processes, programs)
+
+        else:
+            with metrics.registry.timer("tick.foreground_check"):
+                active_program = self.resolve_foreground_program(matcher, programs)
+
+        title = self.capture_title(active_program)
+
+        if self.current_program:
+            # if the current program is set but there is no longer
+            # an active program, stop logging the current program and
+            # set the current program to None
+            if not active_program:
+                log.info(
+                    f"Current program {self.current_program} is no longer running, stopping logs"
+                )
+                self.stop_logging_program(self.current_program)
+                self.current_program = None
+
+            # if the current program is set and there's a new active program,
+            # stop logging the current program and start logging the new one
+            # while setting the current program to the new one
+            elif self.current_program.id != active_program.id:
+                log.info(
+                    f"Current program {self.current_program} is no longer running, "
+                    f"but new program {active_program} is. "
+                    "stopping old and starting new logs"
+                )
+                self.stop_logging_program(self.current_program)
+                self.start_logging_program(active_program, title)
+                self.current_program = active_program
+                self.current_title = title
+
+            # same program, but its window title changed (a new browser tab for
+            # example). each entry has one title, so start a new one
+            elif title != self.current_title:
+                log.info(f"Window title of {active_program} changed, starting a new entry")
+                self.stop_logging_program(self.current_program)
+                self.start_logging_program(active_program, title)
+                self.current_title = title
+
+        else:
+            # if there's an active program but no current program set,
+            # just start logging the active program and set the current
+            # program to the active program
+            if active_program:
+                log.info(
+                    f"Current program {active_program} has started, starting logs"
+                )
+                self.start_logging_program(active_program, title)
+                self.current_program = active_program
+                self.current_title = title
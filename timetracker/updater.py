@@ -31,7 +31,7 @@ import collections
 import logging
 import time
 
-from widgets import YesNoPrompt, InfoBox
+import instance
 
 
 log = logging.getLogger("timetracker.updater")
@@ -113,18 +113,32 @@ def pull_from_github():
         )
 
 
-def restart_app():
-    """This will restart the app"""
+def restart_app(before_restart=None):
+    """This will restart the app
+
+    exec skips the usual shutdown, so ``before_restart`` should do it
+    (like :meth:`tracker.Tracker.close`, which ends the running entry and
+    flushes the buffered ones).
+    """
+    if before_restart:
+        before_restart()
+
+    # the lockfile would still have our PID, which the new process keeps
+    instance.delete_lockfile()
+
     os.execv(sys.argv[0], sys.argv)
     sys.exit()
 
 
-def perform_update(root, restart=True, interactive=False):
+def perform_update(root, restart=True, interactive=False, before_restart=None):
     """Perform the full update process
 
     This includes checking for updates, asking the user for confirmation,
-    pulling from GitHub, and restarting the app.
+    pulling from GitHub, and restarting the app. ``before_restart`` is
+    passed on to :func:`restart_app`.
     """
+    # imported here so the headless tracker can check for updates without Tk
+    from widgets import YesNoPrompt, InfoBox
 
     interactive_notice = " (interactive)" if interactive else ""
     log.info(f"Checking for updates...{interactive_notice}")
@@ -154,4 +168,4 @@ def perform_update(root, restart=True, interactive=False):
 
     if restart:
         log.info("Restarting app...")
-        restart_app()
+        restart_app(before_restart)
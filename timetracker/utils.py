@@ -23,82 +23,131 @@ SOFTWARE.
 """
 
 
-import win32process
-import win32gui
+try:
+    import win32process
+    import win32gui
+    import win32api
+except ImportError:
+    # pywin32 only exists on Windows. The win32 helpers below won't work
+    # without it, but the synthetic activity source (see sources.py) doesn't need them
+    win32process = win32gui = win32api = None
+
 import psutil
-import win32api
 import time
-import os.path
-import multiprocessing.connection
-import logging
-import tempfile
+import collections
 
-LOCKFILE = os.path.normpath(tempfile.gettempdir() + '/timetracker_instance.lock')
+import matching
 
 
-def write_pid():
-    """Writes the app's PID to the lockfile"""
-    with open(LOCKFILE, "w") as f:
-        f.write(str(os.getpid()))
+Window = collections.namedtuple("Window", "hwnd pid visible iconic title")
 
 
-def is_already_running():
-    """Checks if another instance of the app is running"""
-    if not os.path.isfile(LOCKFILE):
-        write_pid()
-        return False
+def enum_windows():
+    """Returns a :class:`Window` for every top-level window, from one EnumWindows pass"""
 
-    with open(LOCKFILE, "r") as f:
-        other_pid = int(f.read())
+    def enumHandler(hwnd, data):
+        windows.append(
+            Window(
+                hwnd,
+                win32process.GetWindowThreadProcessId(hwnd)[1],
+                bool(win32gui.IsWindowVisible(hwnd)),
+                bool(win32gui.IsIconic(hwnd)),
+                win32gui.GetWindowText(hwnd),
+            )
+        )
+        return True
 
-    try:
-        proc = psutil.Process(other_pid)
-        return proc  # process exists and is running
+    windows = []
+    win32gui.EnumWindows(enumHandler, 0)
+    return windows
 
-    except psutil.NoSuchProcess:
-        # process existed but is no longer running
-        # replace old pid with our new one
-        write_pid()
-        return False
 
+class WindowSnapshot:
+    """Every top-level window on the desktop at one moment, indexed by pid
 
-def delete_lockfile():
-    """Deletes the lockfile if it exists"""
-    if os.path.isfile(LOCKFILE):
-        os.remove(LOCKFILE)
-        return True
+    Asking about windows used to mean walking the whole window list once
+    per process. A snapshot walks it once, and every question after that is
+    a dict lookup.
 
+    ``enumerate`` returns the windows as :class:`Window` tuples. It defaults
+    to :func:`enum_windows`, and can be swapped for a fake window list.
+    """
 
-def top_level_windows(pid):
-    """Returns a list of all top-level windows for a given pid"""
+    def __init__(self, enumerate=None):
+        self.by_pid = {}  # pid: [Window]
+        self.count = 0
 
-    def enumHandler(hwnd, data):
-        if win32process.GetWindowThreadProcessId(hwnd)[1] == pid:
-            windows.append(hwnd)
+        for window in (enumerate or enum_windows)():
+            self.by_pid.setdefault(window.pid, []).append(window)
+            self.count += 1
+
+    def windows(self, pid):
+        """Returns the pid's windows"""
+        return self.by_pid.get(pid, [])
+
+    def hwnds(self, pid):
+        """Returns the handles of the pid's windows"""
+        return [window.hwnd for window in self.by_pid.get(pid, [])]
+
+    def is_minimized(self, pid):
+        """Whether none of the pid's windows are visible and restored"""
+        for window in self.by_pid.get(pid, []):
+            if window.visible and not window.iconic:
+                return False
         return True
 
-    windows = []
-    win32gui.EnumWindows(enumHandler, 0)
-    return windows
+    def visible_pids(self):
+        """Returns the set of pids that own a visible, titled window"""
+        return {
+            pid
+            for pid, windows in self.by_pid.items()
+            if any(window.visible and window.title for window in windows)
+        }
 
 
-def window_minimized(pid):
+def top_level_windows(pid, snapshot=None):
+    """Returns a list of all top-level windows for a given pid
+
+    Pass a :class:`WindowSnapshot` when asking about more than one pid.
+    """
+    if snapshot is None:
+        snapshot = WindowSnapshot()
+    return snapshot.hwnds(pid)
+
+
+def visible_window_pids(snapshot=None):
+    """Returns the set of pids that own a visible, titled top-level window"""
+    if snapshot is None:
+        snapshot = WindowSnapshot()
+    return snapshot.visible_pids()
+
+
+def window_minimized(pid, snapshot=None):
     """Returns whether or not a window is minimized"""
-    for hwnd in top_level_windows(pid):
-        if win32gui.IsWindowVisible(hwnd) and not win32gui.IsIconic(hwnd):
-            return False
-    return True
+    if snapshot is None:
+        snapshot = WindowSnapshot()
+    return snapshot.is_minimized(pid)
+
+
+def get_foreground_pid():
+    """Returns the pid that owns the foreground window"""
+    hwnd = win32gui.GetForegroundWindow()
+    return win32process.GetWindowThreadProcessId(hwnd)[1]
+
+
+def get_foreground_title():
+    """Returns the foreground window's title"""
+    return win32gui.GetWindowText(win32gui.GetForegroundWindow())
 
 
 def is_active_window(pid):
     """Detects whether a window is the active window"""
-    hwnd = win32gui.GetForegroundWindow()
-    return pid == win32process.GetWindowThreadProcessId(hwnd)[1]
+    return pid == get_foreground_pid()
 
 
-def program_active(pid):
+def program_active(pid, snapshot=None):
     """Returns whether or not a program is active"""
-    return not window_minimized(pid)  # haha yes it's dumb
+    return not window_minimized(pid, snapshot)  # haha yes it's dumb
 
 
 def get_process(process_name):
@@ -114,14 +163,17 @@ def get_process(process_name):
     return None
 
 
-def get_processes(process_names):
+def get_processes(process_names, process_iter=None):
     """Checks if there are any running processes that contain the given process names
 
-    Basically get_process but checks gets multiple processes
+    Basically get_process but checks gets multiple processes.
+    ``process_iter`` defaults to :func:`psutil.process_iter`.
     """
+    process_iter = process_iter or psutil.process_iter
+
     # process_name: psutil.Process
     processes = {}
-    for proc in psutil.process_iter():
+    for proc in process_iter():
         try:
             proc_name = proc.name().lower()
             processes.update({n: proc for n in process_names if n.lower() in proc_name})
@@ -132,66 +184,174 @@ def get_processes(process_names):
     return processes
 
 
-def get_all_processes():
-    """Returns a dict of the process name to the psutil.Process"""
-    processes = {}
-    for proc in psutil.process_iter():
-        try:
-            proc_name = proc.name()
-            processes[proc_name] = proc
+class ProcessIndex:
+    """A persistent index of running processes keyed by (pid, create_time)
 
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            pass
+    :func:`get_processes` asks every process for its name on every call.
+    This instead diffs the pid list against the last one it saw, so only new
+    processes have their name resolved and dead ones are evicted. Each process
+    is matched once, when it first shows up (or when the rules change).
 
-    return processes
+    Processes are matched with a :class:`matching.Matcher`. The methods that
+    take one also accept a list of process names, which are matched by
+    substring like :func:`get_processes` does.
 
+    ``pids`` and ``process`` default to :func:`psutil.pids` and :class:`psutil.Process`.
+    """
 
-def get_idle_time():
-    """Gets the time in seconds since last idle"""
-    return (win32api.GetTickCount() - win32api.GetLastInputInfo()) / 1000.0
+    def __init__(self, pids=None, process=None):
+        self._pids = pids or psutil.pids
+        self._process = process or psutil.Process
 
+        # pid: (create_time, name, process, exe)
+        # the name is None if we weren't allowed to look at the process, and
+        # the exe is only read while the matcher has exe rules
+        self.processes = {}
 
-def multiprocess_listener(callback, message="open_gui"):
-    """Listen for messages from other processes
+        self.matcher = None
+        self._names_matcher = (None, None)  # (process names, Matcher) for name lists
+        # matcher key: {pid: process} in the order they were found
+        self.matches = {}
 
-    This is used for opening the GUI.
-    """
-    log = logging.getLogger("timetracker.listener")
+    def refresh(self):
+        """Brings the index up to date with the running processes"""
+        current = set(self._pids())
+        known = self.processes.keys()
 
-    address = ("localhost", 8320)  # family is deduced to be 'AF_INET'
-    listener = multiprocessing.connection.Listener(address, authkey=b"hello_world")
+        for pid in known - current:
+            self._evict(pid)
 
-    while True:
-        conn = listener.accept()
-        log.info(f"Connection accepted from {listener.last_accepted}")
+        for pid in current - known:
+            self._resolve(pid)
+
+    def get_processes(self, matcher):
+        """Same as :func:`get_processes`, but only pays for processes that changed
+
+        Returns a dict of matcher key (or process name) to a matching process.
+        """
+        self._prepare(matcher)
+
+        processes = {}
+        for name, procs in self.matches.items():
+            # same as get_processes, the last process found wins
+            for pid in reversed(list(procs)):
+                proc = self._verify(pid)
+                if proc:
+                    processes[name] = proc
+                    break
+
+        return processes
+
+    def lookup(self, pid, matcher):
+        """Returns the key (or process name) that the pid matches, or None"""
+        self._prepare(matcher)
+
+        if pid not in self.processes or not self._verify(pid):
+            return None
+
+        for key, procs in self.matches.items():
+            if pid in procs:
+                return key
+
+        return None
+
+    def _prepare(self, matcher):
+        if not isinstance(matcher, matching.Matcher):
+            process_names = tuple(matcher)
+            if process_names != self._names_matcher[0]:
+                self._names_matcher = (process_names, matching.Matcher.from_names(process_names))
+            matcher = self._names_matcher[1]
+
+        if matcher is not self.matcher:
+            self._rematch(matcher)
 
-        while True:
-            msg = conn.recv()
+        self.refresh()
 
-            if msg == message:
-                log.info(
-                    f"Connection {listener.last_accepted} requested the GUI to be opened"
-                )
-                callback()
+    def _resolve(self, pid):
+        try:
+            proc = self._process(pid)
+            create_time = proc.create_time()
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            return
+        except psutil.AccessDenied:
+            # remember it so we don't keep asking every tick
+            self.processes[pid] = (None, None, None, None)
+            return
+
+        try:
+            name = proc.name()
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            return
+        except psutil.AccessDenied:
+            name = None
+
+        exe = self._read_exe(proc) if self.matcher and self.matcher.needs_exe else None
+        self.processes[pid] = (create_time, name, proc, exe)
+        self._match(pid)
+
+    def _read_exe(self, proc):
+        try:
+            return proc.exe()
+        except psutil.Error:
+            return None
+
+    def _match(self, pid):
+        create_time, name, proc, exe = self.processes[pid]
+        if proc is None:
+            return
+
+        key = self.matcher.match(name, exe)
+        if key is not None:
+            self.matches[key][pid] = proc
+
+    def _evict(self, pid):
+        self.processes.pop(pid, None)
+        for procs in self.matches.values():
+            procs.pop(pid, None)
+
+    def _verify(self, pid):
+        """Makes sure the pid hasn't been reused since we indexed it"""
+        proc = self.processes[pid][2]
+        if proc is None:
+            return None
+
+        try:
+            # psutil compares the create time for us here
+            if proc.is_running():
+                return proc
+        except psutil.Error:
+            pass
+
+        self._evict(pid)
+        self._resolve(pid)
+        return None
 
-            elif msg == "close":
-                log.info(f"Connection {listener.last_accepted} is closing the connection")
-                conn.close()
-                break
+    def _rematch(self, matcher):
+        self.matcher = matcher
+        self.matches = {key: {} for key in matcher.keys}
 
-    listener.close()
+        for pid, (create_time, name, proc, exe) in list(self.processes.items()):
+            if matcher.needs_exe and exe is None and proc is not None:
+                exe = self._read_exe(proc)
+                self.processes[pid] = (create_time, name, proc, exe)
 
+            self._match(pid)
 
-def multiprocess_sender(msg="open_gui"):
-    """Send a message to another process.
 
-    See :func:`multiprocess_listener`
+def iter_process_info():
+    """Yields (pid, name, exe) for every process, fetching the attributes in bulk
+
+    exe is None when it can't be read (which is common for system processes).
     """
-    address = ("localhost", 8320)
-    conn = multiprocessing.connection.Client(address, authkey=b"hello_world")
-    conn.send(msg)
-    conn.send("close")
-    conn.close()
+    for proc in psutil.process_iter(["pid", "name", "exe"], ad_value=None):
+        info = proc.info
+        if info["name"]:
+            yield info["pid"], info["name"], info["exe"]
+
+
+def get_idle_time():
+    """Gets the time in seconds since last idle"""
+    return (win32api.GetTickCount() - win32api.GetLastInputInfo()) / 1000.0
 
 
 def loop(seconds, callback):
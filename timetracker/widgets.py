@@ -27,9 +27,11 @@ import tkinter as tk
 from tkinter import ttk
 import tkinter.font as tk_font
 import datetime
+import queue
+import re
 
-from models import session, Program, TimeEntry
-import utils
+from models import session, Program
+import matching
 
 
 class YesNoPrompt(tk.Toplevel):
@@ -89,20 +91,46 @@ class AddProgramDisplay(tk.Toplevel):
         self.name_entry = tk.Entry(self)
         self.name_entry.pack()
 
-        # get a list of all processes running
-        # FIXME: THIS TAKES FOREVER!!! ALSO IT SHOWS EVERY SINGLE PROCESS!!
-        # TODO: make this only show open windows (without taking a century)
-        self.program_dict = program_dict = utils.get_all_processes()
-        sorted_keys = list(sorted(program_dict.keys(), key=lambda x: x.lower()))
+        # the processes are listed in the background and added
+        # to the dropdown as they come in. see load_processes
+        self.program_dict = {}
 
         # make the dropdown
-        dropdown_var = tk.StringVar()
-        dropdown_var.set(sorted_keys[0])
+        self.dropdown_var = tk.StringVar()
+        self.dropdown = ttk.Combobox(self, textvariable=self.dropdown_var, values=[])
+        self.dropdown.pack()
 
-        self.dropdown = ttk.Combobox(
-            self, textvariable=dropdown_var, values=sorted_keys
+        # how the process is recognized. anything but exact and exe lets
+        # you type a pattern into the dropdown instead of picking a process
+        match_text = tk.Message(self, text="Match by")
+        match_text.pack()
+
+        self.match_type_var = tk.StringVar(value="exact")
+        match_type_dropdown = ttk.Combobox(
+            self, textvariable=self.match_type_var, values=matching.MATCH_TYPES, state="readonly"
         )
-        self.dropdown.pack()
+        match_type_dropdown.pack()
+
+        # off by default, titles can have all sorts in them
+        self.capture_titles = tk.BooleanVar(value=False)
+        capture_titles_button = tk.Checkbutton(
+            self, text="Record window titles", variable=self.capture_titles
+        )
+        capture_titles_button.pack()
+
+        self.loading_status = tk.StringVar()
+        loading_label = tk.Label(self, textvariable=self.loading_status)
+        loading_label.pack()
+
+        # by default only processes with a window are listed
+        self.show_all = tk.BooleanVar(value=False)
+        show_all_button = tk.Checkbutton(
+            self, text="Show all processes", variable=self.show_all, command=self.load_processes
+        )
+        show_all_button.pack()
+
+        self.results = None
+        self.load_processes()
 
         save_button = tk.Button(self, text="Save", command=self.save_to_db)
         save_button.pack()
@@ -118,19 +146,94 @@ class AddProgramDisplay(tk.Toplevel):
             return
 
         option = self.dropdown.get()
+        match_type = self.match_type_var.get()
+        program = self.program_dict.get(option)
 
-        try:
-            program = self.program_dict[option]
-        except KeyError:
-            # TODO: warning thingy like above
-            return
+        if match_type in ("exact", "exe"):
+            if not program:
+                # TODO: warning thingy like above
+                return
+
+            if match_type == "exe" and not program.exe:
+                self.loading_status.set(f"Couldn't read where {program.name} is installed")
+                return
+
+            pattern = program.exe if match_type == "exe" else program.name
 
-        to_add = Program(name=name, process_name=program.name(), location=program.exe())
+        else:
+            if not option:
+                return
+
+            if match_type == "regex":
+                try:
+                    # the same way the matcher will, so a rule that saves also matches
+                    matching.MatchRule(None, "regex", option).compile()
+                except re.error as e:
+                    self.loading_status.set(f"Invalid regex: {e}")
+                    return
+
+            pattern = option
+
+        to_add = Program(
+            name=name,
+            process_name=program.name if program else option,
+            location=(program.exe or "") if program else "",
+            match_type=match_type,
+            match_pattern=pattern,
+            capture_titles=self.capture_titles.get(),
+        )
         session.add(to_add)
         session.commit()
 
+        # let the activity loop know about the new program
+        self.master.master.registry.invalidate()
+
         self.destroy()
 
+    def load_processes(self):
+        """Starts (or reuses) a background listing of processes"""
+        self.program_dict = {}
+        self.dropdown["values"] = []
+        self.loading_status.set("Loading processes...")
+
+        catalog = self.master.master.process_catalog
+        self.results = catalog.scan(windowed_only=not self.show_all.get())
+        self.poll_processes(self.results)
+
+    def poll_processes(self, results):
+        """Adds any processes that have come in to the dropdown"""
+        if results is not self.results or not self.winfo_exists():
+            # the listing was restarted, or the display was closed
+            return
+
+        done = False
+        added = False
+        while True:
+            try:
+                batch = results.get_nowait()
+            except queue.Empty:
+                break
+
+            if batch is None:
+                done = True
+                break
+
+            for info in batch:
+                self.program_dict[info.name] = info
+            added = True
+
+        if added:
+            names = sorted(self.program_dict, key=lambda x: x.lower())
+            self.dropdown["values"] = names
+            if not self.dropdown_var.get():
+                self.dropdown_var.set(names[0])
+
+        if done:
+            self.loading_status.set(f"{len(self.program_dict)} processes")
+        else:
+            self.loading_status.set(f"Loading processes... ({len(self.program_dict)})")
+            self.after(50, self.poll_processes, results)
+
 
 class RemoveProgramDisplay(tk.Toplevel):
     def __init__(self, master):
@@ -170,8 +273,14 @@ class RemoveProgramDisplay(tk.Toplevel):
             # TODO: error maybe
             return
 
-        session.delete(program)
-        session.commit()
+        # the registry's programs are detached, so delete the session's copy
+        program = session.get(Program, program.id)
+        if program is not None:
+            session.delete(program)
+            session.commit()
+
+        # stop the activity loop from tracking it
+        self.master.master.registry.invalidate()
 
         self.destroy()
 
@@ -324,16 +433,11 @@ class MainDisplay(tk.Frame):
         self.master.master.config(menu=self.menubar)
 
         self.last_checked = None
-        entries = self.get_todays_time_entries()
-        self.is_paused = True
-        self.counting_program_id = None
+        self.totals_version = None
+        todays = self.get_todays_totals()
 
         self.status = tk.StringVar()
-        self.status.set(
-            f"Counting {master.current_program}"
-            if master.current_program
-            else "Currently Paused"
-        )
+        self.update_status(todays)
 
         # == Main counter section ==
 
@@ -344,7 +448,7 @@ class MainDisplay(tk.Frame):
         self.status_label.grid(column=0, row=0, sticky=tk.W, padx=20, pady=5)
         self.status_label["textvariable"] = self.status
 
-        self.main_time = ProgramTimeDisplay(*self.calculate_timedelta(entries))
+        self.main_time = ProgramTimeDisplay(*self.calculate_timedelta(todays))
         self.main_time.update_time()
 
         # Create main counter label
@@ -360,7 +464,7 @@ class MainDisplay(tk.Frame):
         self.program_header.grid(column=0, row=3, sticky=tk.W, padx=20, pady=(10, 2))
 
         # Actual list of programs
-        self.programs_var = ProgramListDisplay(self.get_program_times(entries))
+        self.programs_var = ProgramListDisplay(self.get_program_times(todays))
         self.programs_var.update_programs()
 
         self.program_list_label = tk.Label(
@@ -376,10 +480,10 @@ class MainDisplay(tk.Frame):
         popup = AddProgramDisplay(self)
         self.wait_window(popup)
         self.master.load_programs()
-        entries = self.get_todays_time_entries()
-        self.main_time.update_attrs(*self.calculate_timedelta(entries))
+        todays = self.get_todays_totals()
+        self.main_time.update_attrs(*self.calculate_timedelta(todays))
         self.main_time.update_time()
-        self.programs_var.update_attrs(self.get_program_times(entries))
+        self.programs_var.update_attrs(self.get_program_times(todays))
         self.programs_var.update_programs()
 
     def remove_program(self):
@@ -387,10 +491,10 @@ class MainDisplay(tk.Frame):
         popup = RemoveProgramDisplay(self)
         self.wait_window(popup)
         self.master.load_programs()
-        entries = self.get_todays_time_entries()
-        self.main_time.update_attrs(*self.calculate_timedelta(entries))
+        todays = self.get_todays_totals()
+        self.main_time.update_attrs(*self.calculate_timedelta(todays))
         self.main_time.update_time()
-        self.programs_var.update_attrs(self.get_program_times(entries))
+        self.programs_var.update_attrs(self.get_program_times(todays))
         self.programs_var.update_programs()
 
     def stop_app(self):
@@ -404,7 +508,7 @@ class MainDisplay(tk.Frame):
         if not prompt.result:
             return
 
-        self.master.master.destroy()
+        self.master.stop_app()
 
     def open_about_window(self):
         """Opens the about window"""
@@ -413,111 +517,86 @@ class MainDisplay(tk.Frame):
     def check_for_updates(self):
         """Runs a more interactive updater session"""
         from updater import perform_update
-        perform_update(self, interactive=True)
+        perform_update(self, interactive=True, before_restart=self.master.tracker.close)
 
-    def get_program_times(self, all_entries):
+    def get_program_times(self, todays):
         """Generates a list of :class:`ProgramTime`s to be used in the :class:`ProgramListDisplay"""
         program_times = []
 
         for program in self.master.programs:
             timedelta, current_time = self.calculate_timedelta(
-                all_entries, program_id=program.id
+                todays, program_id=program.id
             )
             program_times.append(ProgramTime(program, timedelta, current_time))
 
         return program_times
 
-    def calculate_timedelta(self, all_entries, program_id=None):
+    def calculate_timedelta(self, todays, program_id=None):
         """Calculates a timedelta for a given program or all programs if None is passed"""
+        totals, current = todays
+
         if not program_id:
-            entries = [e for e in all_entries]
+            total_seconds = sum(totals.values())
 
         else:
-            entries = [e for e in all_entries if e.program_id == program_id]
+            total_seconds = totals.get(program_id, 0.0)
+            if current and current[0] != program_id:
+                current = None
 
-        total_timedelta = datetime.timedelta()
+        total_timedelta = datetime.timedelta(seconds=total_seconds)
         current_time = None
 
-        for i, entry in enumerate(reversed(entries)):
-            if entry.end_datetime:
-                total_timedelta += entry.end_datetime - entry.start_datetime
-
-            elif i == 0:
-                current_time = entry.start_datetime
+        if current:
+            # only count the part of the running entry that happened today
+            current_time = max(current[1], self.utc_midnight())
 
         return total_timedelta, current_time
 
-    def get_todays_time_entries(self):
-        """Gets a list of today's entries so far"""
+    def utc_midnight(self):
+        """Returns local midnight as a UTC datetime"""
         today = datetime.datetime.today()
         todays_datetime = datetime.datetime(today.year, today.month, today.day)
         offset = datetime.datetime.now() - datetime.datetime.utcnow()
-        utc_today = todays_datetime - offset
-
-        # def is_today(entry_time):
-        #     UTC_timestamp = float(entry_time.strftime("%s"))
-        #     local_entry_time = datetime.datetime.fromtimestamp(UTC_timestamp)
-
-        #     return local_entry_time >= todays_datetime
+        return todays_datetime - offset
 
-        entries = (
-            session.query(TimeEntry)
-            .filter(TimeEntry.start_datetime >= utc_today)
-            .order_by(TimeEntry.end_datetime.desc())
-        ).all()
+    def get_todays_totals(self):
+        """Gets today's totals so far from the app's :class:`TodayAggregator`
 
+        Returns a tuple of ({program_id: seconds}, (program_id, utc start) or None).
+        """
         self.last_checked = datetime.datetime.utcnow()
+        # read before the snapshot, so a change in between just means an extra one next time
+        self.totals_version = self.master.today.version
+        return self.master.today.snapshot()
+
+    def update_status(self, todays):
+        """Sets the status line from a snapshot's running entry"""
+        current = todays[1]
+        if not current:
+            self.status.set("Currently Paused")
+            return
 
-        return entries
+        program = self.master.registry.by_id.get(current[0])
+        self.status.set(f"Tracking {program.name if program else 'a removed program'}")
 
     def counter_loop(self):
         """Loop that counts up the counter"""
-
-        # if the counter is paused and the current program doesn't exist,
-        # then just keep being paused because nothing has changed
-        if self.is_paused and self.master.current_program:
-            entries = self.get_todays_time_entries()
-            self.main_time.update_attrs(*self.calculate_timedelta(entries))
-            self.main_time.update_time()
-            self.programs_var.update_attrs(self.get_program_times(entries))
-            self.programs_var.update_programs()
-            self.counting_program_id = self.master.current_program.id
-            self.is_paused = False
-            self.status.set(f"Tracking {self.master.current_program.name}")
-
-        # if the counter isn't paused and the current program doesn't exist,
-        # then the logging stopped and the counter should too
-        elif not self.is_paused and not self.master.current_program:
-            entries = self.get_todays_time_entries()
-            self.main_time.update_attrs(*self.calculate_timedelta(entries))
+        today = self.master.today
+
+        # the aggregator's version changes once the db worker has applied a start
+        # or stop, so the snapshot always includes it. going by the tracker's
+        # current program could snapshot before the stopped entry was counted
+        if today.version != self.totals_version or datetime.date.today() != today.day:
+            todays = self.get_todays_totals()
+            self.main_time.update_attrs(*self.calculate_timedelta(todays))
             self.main_time.update_time()
-            self.programs_var.update_attrs(self.get_program_times(entries))
+            self.programs_var.update_attrs(self.get_program_times(todays))
             self.programs_var.update_programs()
-            self.is_paused = True
-            self.counting_program_id = None
-            self.status.set("Currently Paused")
+            self.update_status(todays)
 
-        # if the counter isn't paused and the current program matches the program we're currently
-        # counting, then just update the time again because nothing has changed
-        elif (
-            not self.is_paused
-            and self.master.current_program.id == self.counting_program_id
-        ):
-            self.main_time.update_time()
-            self.programs_var.update_programs()
-
-        # finally, if the counter isn't paused and the current program doesn't match
-        # the program we're currently counting, then the program has changed since
-        # the last loop and we need to check the db again
-        elif (
-            not self.is_paused
-            and self.master.current_program.id != self.counting_program_id
-        ):
-            entries = self.get_todays_time_entries()
-            self.main_time.update_attrs(*self.calculate_timedelta(entries))
+        # otherwise nothing has changed, so just count the time up again
+        else:
             self.main_time.update_time()
-            self.programs_var.update_attrs(self.get_program_times(entries))
             self.programs_var.update_programs()
-            self.counting_program_id = self.master.current_program.id
 
         self.after(1000, self.counter_loop)